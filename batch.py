@@ -0,0 +1,275 @@
+"""Compile many tables at once across a pool of processes
+
+A batch is a list of specs, each naming a builder with its arguments:
+
+    specs = [text_spec("hello"), scan_spec(1000, time1=990, time2=10)]
+    with compile_batch(specs) as results:
+        for chunks in results:
+            tables = [chunk.to_table() for chunk in chunks]
+
+Every spec is built in a worker process, which copies the FRAME_DTYPE rows it
+produces into a shared memory block and only sends back the block's name and
+the chunk lengths. The parent maps each block as an array so no rows are
+pickled. Results are in the same order as the specs whatever order they
+finish in, and each is a list of FrameBuffers viewing its shared memory,
+which is released when the BatchResult is closed and the chunks are dropped.
+
+If a table_store.TableStore is given, specs already in it are loaded from it
+and only the rest are compiled, after which they are saved to it. Specs use
+the same keys as the rest of the code, so a batch run at startup can prepare
+the tables later used by configure_text, collect_n and the display: a scroll
+is stored a chunk at a time under the keys CachedTableStream looks up.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import scan
+import tables
+from table_store import IntegrityError
+
+
+def _configure_text(txt, font, start, step):
+    from p45demo.panda_plans import text_rows
+
+    return text_rows(txt, font, start, step)
+
+
+def _scan(count, length, **columns):
+    return list(scan.compile_scan(scan.point_blocks(count, **columns), length))
+
+
+def _scroll(text, width, length, posn, step):
+    bits = tables.bit_matrix(text)
+    period = tables.scroll_period(len(bits), width, length, posn, step)
+    return [
+        tables.scroll_chunk(bits, width, length, index, posn, step)
+        for index in range(period)
+    ]
+
+
+BUILDERS = {"configure_text": _configure_text, "scan": _scan, "scroll": _scroll}
+"""Functions building each kind of spec, run in the worker processes"""
+
+
+def text_spec(txt, font=tables.FONT, start=600, step=8):
+    """Spec for the static banner written by panda_plans.configure_text"""
+    return "configure_text", (txt, font, start, step), {}
+
+
+def scan_spec(count, length=1024, **columns):
+    """Spec for the chunks of a scan, as given by scan.cached_scan"""
+    return "scan", (count, length), columns
+
+
+def scroll_spec(text, width, length, posn=600, step=6):
+    """Spec for one full cycle of the scrolling display of text"""
+    return "scroll", (text, width, length, posn, step), {}
+
+
+def _keys(store, spec):
+    """Store key of a spec, or the key of each chunk of a scroll"""
+    name, args, kwargs = spec
+    if name != "scroll":
+        return store.key(name, *args, **kwargs)
+    text, width, length, posn, step = args
+    period = tables.scroll_period(
+        len(tables.bit_matrix(text)), width, length, posn, step
+    )
+    return [
+        store.key("scroll_chunk", text, tables.FONT, width, length, i, posn, step)
+        for i in range(period)
+    ]
+
+
+def _load(store, keys):
+    """Stored chunks for keys from _keys, or None if any are missing"""
+    try:
+        if isinstance(keys, list):
+            chunks = [store.get(key) for key in keys]
+            return None if None in chunks else chunks
+        stored = store.get(keys)
+    except IntegrityError:
+        return None
+    return [stored] if isinstance(stored, tables.FrameBuffer) else stored
+
+
+def _save(store, keys, chunks, single):
+    if isinstance(keys, list):
+        for key, chunk in zip(keys, chunks):
+            store.put(key, chunk)
+    else:
+        store.put(keys, chunks[0] if single else chunks)
+
+
+def _build(spec):
+    """Build a spec in a worker, returning its shared memory and chunk lengths
+
+    Also returns whether the builder gave a single FrameBuffer, so it is
+    stored as one like the rest of the code stores it.
+    """
+    name, args, kwargs = spec
+    built = BUILDERS[name](*args, **kwargs)
+    single = isinstance(built, tables.FrameBuffer)
+    chunks = [built] if single else built
+    lengths = [len(chunk) for chunk in chunks]
+    size = sum(lengths) * tables.FRAME_DTYPE.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        rows = np.ndarray(sum(lengths), tables.FRAME_DTYPE, shm.buf)
+        start = 0
+        for chunk, length in zip(chunks, lengths):
+            rows[start : start + length] = chunk.data
+            start += length
+        del rows
+    finally:
+        shm.close()
+    return shm.name, lengths, single
+
+
+def _chunks(rows, lengths):
+    offsets = np.cumsum([0] + lengths)
+    return [
+        tables.FrameBuffer.from_array(rows[start:end])
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def _release(blocks):
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError:
+            # Tables still view the block, it is unmapped when they go
+            pass
+        shm.unlink()
+
+
+def _discard(futures):
+    """Cancel builds not yet started and unlink the blocks of the others"""
+    for future in futures:
+        future.cancel()
+    for future in futures:
+        if future.cancelled() or future.exception() is not None:
+            continue
+        try:
+            _release([shared_memory.SharedMemory(future.result()[0])])
+        except FileNotFoundError:
+            pass
+
+
+class BatchResult:
+    """Chunks of each spec in order, backed by shared memory until closed"""
+
+    def __init__(self, results, blocks):
+        self.results = results
+        self._blocks = blocks
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def close(self):
+        """Release the shared memory once the chunks built in it are dropped"""
+        self.results = []
+        _release(self._blocks)
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compile_batch(specs, workers=None, store=None):
+    """Build every spec using workers processes (one per CPU by default)
+
+    Returns a BatchResult with a list of FrameBuffer chunks for each spec. If
+    store is given, stored specs are loaded from it and the rest saved to it.
+    If anything fails, the shared memory of every spec is released before the
+    error is raised.
+    """
+    specs = list(specs)
+    results = [None] * len(specs)
+    keys = [None] * len(specs)
+    if store is not None:
+        for index, spec in enumerate(specs):
+            keys[index] = _keys(store, spec)
+            results[index] = _load(store, keys[index])
+    missing = [index for index, result in enumerate(results) if result is None]
+    blocks = []
+    if missing:
+        workers = min(workers or os.cpu_count() or 1, len(missing))
+        # Workers must share the parent's tracker, one of their own would
+        # remove their blocks as leaked when they exit
+        resource_tracker.ensure_running()
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_build, specs[index]) for index in missing]
+            try:
+                for index, future in zip(missing, futures):
+                    block, lengths, single = future.result()
+                    shm = shared_memory.SharedMemory(block)
+                    blocks.append(shm)
+                    rows = np.ndarray(sum(lengths), tables.FRAME_DTYPE, shm.buf)
+                    results[index] = _chunks(rows, lengths)
+                    if store is not None:
+                        _save(store, keys[index], results[index], single)
+            except BaseException:
+                # Drop the views of the blocks so that they can be closed
+                results = rows = None
+                _release(blocks)
+                _discard(futures[len(blocks) :])
+                raise
+    return BatchResult(results, blocks)
+
+
+def test_compile_batch(tmp_path):
+    from table_store import TableStore
+
+    specs = [
+        scan_spec(8, 2, time1=np.repeat([100, 200], [5, 3]), time2=10),
+        scroll_spec("ab", 12, 20),
+        scan_spec(3, time1=50),
+    ]
+    with compile_batch(specs, workers=2) as results:
+        assert len(results) == 3
+        assert results[0] == _scan(8, 2, time1=np.repeat([100, 200], [5, 3]), time2=10)
+        assert results[1] == _scroll("ab", 12, 20, 600, 6)
+        assert [row.repeats for row in results[2][0]] == [3]
+        assert (results[2][0].to_table()["TIME1"] == [50]).all()
+
+    store = TableStore(tmp_path)
+    with compile_batch(specs[:2], workers=2, store=store) as results:
+        period = len(results[1])
+        assert len(store.entries()) == 1 + period
+    time1 = np.repeat([100, 200], [5, 3])
+    assert len(scan.cached_scan(store, 8, 2, time1=time1, time2=10)) == 1
+    assert store.hits == 1
+    # The display finds every chunk of the scroll in the store
+    stream = tables.CachedTableStream("ab", 12, 20, store=store)
+    for _ in range(period):
+        next(stream)
+    assert store.hits == 1 + period and store.misses == 0
+    with compile_batch(specs[:2], workers=2, store=store) as results:
+        assert results[1] == _scroll("ab", 12, 20, 600, 6)
+
+
+def test_compile_batch_error():
+    specs = [("missing", (), {}), scan_spec(3, time1=50), scan_spec(4, time1=60)]
+    before = set(os.listdir("/dev/shm"))
+    try:
+        compile_batch(specs, workers=2)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("an unknown builder should fail")
+    assert set(os.listdir("/dev/shm")) <= before
@@ -0,0 +1,390 @@
+"""Benchmarks for the table generation pipeline and the display loop
+
+Each case is run over a grid of text length, window, step and chunk size and
+reports rows/s, tables/s and peak traced memory. Results are written as JSON
+and can be compared against a stored baseline to catch regressions before
+they reach the sequencer:
+
+    $ python benchmarks.py --output results.json --baseline baseline.json
+
+The positions case converts raw Tetramm currents to positions (see
+positions.py) and its rows/s is samples per second on one core.
+
+The batch case compiles a batch of scans with batch.compile_batch using 1 and
+more worker processes, including the time taken to start the pool.
+
+The display case runs tables.display against a SimPandA (see sim_panda.py) and
+includes the engine's underrun count, which is the number that matters for
+whether table generation keeps up with the sequencer.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+from itertools import cycle, islice, product
+from time import perf_counter
+
+import numpy as np
+
+import tables
+
+TEXT = "helloWorld "
+
+GRID = {
+    "text_length": (10, 100),
+    "window": (30, 100),
+    "step": (6, 40),
+    "chunk": (100, 1000),
+    "values_per_reading": (1, 10),
+    "geometry": ("Square", "Diamond"),
+    "workers": (1, 4),
+}
+"""Parameter values benchmarked by default"""
+
+QUICK_GRID = {name: values[:1] for name, values in GRID.items()}
+
+TABLES = 20
+"""Number of tables generated by each case"""
+
+SAMPLES = 1_000_000
+"""Number of raw Tetramm samples converted to positions by the positions case"""
+
+BATCH = 16
+"""Number of scans compiled by the batch case"""
+
+BATCH_POINTS = 100_000
+"""Number of points in each scan compiled by the batch case"""
+
+
+def sample_text(length):
+    """Text of the given length made by repeating TEXT"""
+    return "".join(islice(cycle(TEXT), length))
+
+
+def measure(name, params, fn, repeat=3):
+    """Time fn, which returns (rows, tables) produced, and trace its memory
+
+    The best of repeat runs is used for the rates. Peak memory is taken from a
+    separate traced run as tracemalloc slows down allocation heavy code.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        rows, count = fn()
+        best = min(best, perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "name": name,
+        "params": params,
+        "seconds": best,
+        "rows": rows,
+        "tables": count,
+        "rows_per_second": rows / best if best else None,
+        "tables_per_second": count / best if best else None,
+        "peak_memory": peak,
+    }
+
+
+def _frame_chunks(text, window, step, chunk):
+    frames = cycle(tables.frames(text))
+    return tables.table_chunks(tables.table_frames(frames, window, 600, step), chunk)
+
+
+def bench_frames(text_length, **_):
+    text = sample_text(text_length)
+
+    def run():
+        rows = len(list(tables.frames(text)))
+        return rows, 0
+
+    return run
+
+
+def bench_table_frames(text_length, window, step, chunk, **_):
+    text = sample_text(text_length)
+
+    def run():
+        frames = cycle(tables.frames(text))
+        rows = tables.table_frames(frames, window, 600, step)
+        return len(list(islice(rows, TABLES * chunk))), 0
+
+    return run
+
+
+def bench_table_chunks(text_length, window, step, chunk, **_):
+    text = sample_text(text_length)
+
+    def run():
+        chunks = list(islice(_frame_chunks(text, window, step, chunk), TABLES))
+        return sum(map(len, chunks)), len(chunks)
+
+    return run
+
+
+def bench_seq_tables(text_length, window, step, chunk, **_):
+    text = sample_text(text_length)
+    chunks = list(islice(_frame_chunks(text, window, step, chunk), TABLES))
+
+    def run():
+        built = list(tables.seq_tables(chunks))
+        return sum(len(t["REPEATS"]) for t in built), len(built)
+
+    return run
+
+
+def bench_scroll_chunks(text_length, window, step, chunk, **_):
+    text = sample_text(text_length)
+
+    def run():
+        bits = tables.bit_matrix(text)
+        chunks = tables.scroll_chunks(bits, window, chunk, 600, step)
+        built = list(tables.seq_tables(islice(chunks, TABLES)))
+        return sum(len(t["REPEATS"]) for t in built), len(built)
+
+    return run
+
+
+def bench_configure_text(text_length, step, **_):
+    from p45demo import panda_plans
+
+    text = sample_text(text_length)
+
+    def run():
+        # Build the table directly, configure_text would load it from the
+        # table store after the first run
+        table = panda_plans.text_rows(text, step=step).to_table()
+        return len(table["REPEATS"]), 1
+
+    return run
+
+
+def bench_display(text_length, window, step, chunk, speed=50, **_):
+    import sim_panda
+
+    text = sample_text(text_length)
+    engine_stats = {}
+
+    async def display():
+        pnd, engine = await sim_panda.sim_panda()
+        engine.start(speed=speed)
+        try:
+            stats = await tables.display(
+                pnd, text, limit=TABLES, posn=600, step=step, window=window, chunk=chunk
+            )
+        finally:
+            await engine.stop()
+        engine_stats.update(engine.stats(), starved=stats.starved)
+        return stats
+
+    def run():
+        # display reports progress on stdout, which may be carrying the JSON
+        with redirect_stdout(sys.stderr):
+            stats = asyncio.run(display())
+        return stats.tables * (chunk + 1), stats.tables
+
+    run.engine_stats = engine_stats
+    return run
+
+
+def bench_positions(values_per_reading, geometry, **_):
+    from positions import PositionCalculator
+
+    currents = np.random.default_rng(0).uniform(0, 1e-6, (4, SAMPLES))
+    calc = PositionCalculator(geometry, values_per_reading=values_per_reading)
+    out = np.empty((3, calc.readings(SAMPLES)))
+
+    def run():
+        calc.reset()
+        calc.feed(currents, out)
+        # Samples per second, on the one core the calculation runs on
+        return SAMPLES, 0
+
+    return run
+
+
+def bench_batch(chunk, workers, **_):
+    from batch import compile_batch, scan_spec
+
+    rng = np.random.default_rng(0)
+    # Exposures vary point to point so the rows are not folded into repeats
+    specs = [
+        scan_spec(
+            BATCH_POINTS,
+            chunk,
+            time1=rng.integers(100, 1000, BATCH_POINTS),
+            time2=10,
+        )
+        for _ in range(BATCH)
+    ]
+
+    def run():
+        with compile_batch(specs, workers) as results:
+            rows = sum(len(chunk) for chunks in results for chunk in chunks)
+            count = sum(map(len, results))
+        return rows, count
+
+    return run
+
+
+CASES = {
+    "frames": (bench_frames, ("text_length",)),
+    "table_frames": (bench_table_frames, ("text_length", "window", "step", "chunk")),
+    "table_chunks": (bench_table_chunks, ("text_length", "window", "step", "chunk")),
+    "seq_tables": (bench_seq_tables, ("text_length", "window", "step", "chunk")),
+    "scroll_chunks": (bench_scroll_chunks, ("text_length", "window", "step", "chunk")),
+    "configure_text": (bench_configure_text, ("text_length", "step")),
+    "display": (bench_display, ("text_length", "window", "step", "chunk")),
+    "positions": (bench_positions, ("values_per_reading", "geometry")),
+    "batch": (bench_batch, ("chunk", "workers")),
+}
+"""Benchmark factories and the GRID parameters each one depends on"""
+
+
+def run_benchmarks(names=None, grid=None, repeat=3):
+    """Run the named cases (all by default) over grid and return the results"""
+    grid = grid or GRID
+    results = []
+    for name in names or CASES:
+        factory, keys = CASES[name]
+        for values in product(*(grid[key] for key in keys)):
+            params = dict(zip(keys, values))
+            fn = factory(**params)
+            # The display loop is paced by the simulated sequencer so there
+            # is little to gain from repeating it
+            result = measure(name, params, fn, 1 if name == "display" else repeat)
+            if hasattr(fn, "engine_stats"):
+                result["engine"] = dict(fn.engine_stats)
+            results.append(result)
+            print(_summary(result), file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def _summary(result):
+    params = " ".join(f"{k}={v}" for k, v in result["params"].items())
+    return (
+        f"{result['name']:>15} {params:<45} "
+        f"{result['rows_per_second'] or 0:>12.0f} rows/s "
+        f"{result['tables_per_second'] or 0:>9.1f} tables/s "
+        f"{result['peak_memory'] / 1024:>9.0f} KiB"
+    )
+
+
+def _key(result):
+    return result["name"], tuple(sorted(result["params"].items()))
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Find results more than tolerance slower (or larger) than the baseline
+
+    Returns a list of (name, params, metric, baseline value, current value).
+    Cases missing from either set of results are ignored.
+    """
+    previous = {_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        for metric in ("rows_per_second", "tables_per_second"):
+            if old[metric] and result[metric] is not None:
+                if result[metric] < old[metric] * (1 - tolerance):
+                    regressions.append(
+                        (
+                            result["name"],
+                            result["params"],
+                            metric,
+                            old[metric],
+                            result[metric],
+                        )
+                    )
+        if result["peak_memory"] > old["peak_memory"] * (1 + tolerance):
+            regressions.append(
+                (
+                    result["name"],
+                    result["params"],
+                    "peak_memory",
+                    old["peak_memory"],
+                    result["peak_memory"],
+                )
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help=f"cases to run from {list(CASES)}")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="smallest grid only")
+    args = parser.parse_args(argv)
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f"unknown cases: {sorted(unknown)}")
+
+    results = run_benchmarks(
+        args.cases or None, QUICK_GRID if args.quick else GRID, args.repeat
+    )
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as src:
+            regressions = compare(results, json.load(src), args.tolerance)
+        for name, params, metric, old, new in regressions:
+            print(
+                f"REGRESSION {name} {params} {metric}: {old:.4g} -> {new:.4g}",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+def test_compare():
+    def result(rate, peak=1000):
+        return {
+            "name": "frames",
+            "params": {"text_length": 10},
+            "rows_per_second": rate,
+            "tables_per_second": None,
+            "peak_memory": peak,
+        }
+
+    baseline = {"results": [result(100.0)]}
+    assert compare({"results": [result(90.0)]}, baseline) == []
+    assert compare({"results": [result(70.0)]}, baseline)[0][2] == "rows_per_second"
+    assert compare({"results": [result(100.0, 2000)]}, baseline)[0][2] == "peak_memory"
+
+
+def test_run_benchmarks_quick():
+    results = run_benchmarks(["frames", "table_chunks", "scroll_chunks"], QUICK_GRID, 1)
+    assert [r["name"] for r in results["results"]] == [
+        "frames",
+        "table_chunks",
+        "scroll_chunks",
+    ]
+    assert all(r["rows_per_second"] > 0 for r in results["results"])
+    assert results["results"][1]["tables"] == TABLES
+    json.dumps(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Plan stubs for collecting from flyers as frames arrive
+
+Rather than polling on a fixed sleep, collect_while_completing waits on the
+frame counters of the devices being flown and collects as soon as enough new
+frames have arrived, or when max_latency has passed since the last collect if
+frames are arriving slowly. Page sizes are then steady at high rates and the
+latency of each page is bounded at low ones.
+"""
+
+import asyncio
+from time import monotonic
+
+from bluesky import plan_stubs as bps
+from bluesky.protocols import EventPageCollectable
+
+
+class FrameWatcher:
+    """Track how many frames have arrived since the last collect
+
+    counters are objects with subscribe_value/clear_sub, such as ophyd signals
+    or a PandaCapture, each reporting a running total of frames. The watcher
+    wakes when any of them has advanced by frames, or a watched status has
+    finished.
+    """
+
+    def __init__(self, counters, frames=100):
+        self.counters = list(counters)
+        self.frames = frames
+        self.totals = [None] * len(self.counters)
+        self.collected = [None] * len(self.counters)
+        self._callbacks = []
+        self._event = None
+        self._waiter = None
+
+    def _update(self, index, value):
+        self.totals[index] = value
+        if self.collected[index] is None:
+            self.collected[index] = value
+        if self.pending() >= self.frames:
+            self._event.set()
+
+    def pending(self):
+        """Largest number of uncollected frames across the counters"""
+        return max(
+            (
+                total - collected
+                for total, collected in zip(self.totals, self.collected)
+                if total is not None
+            ),
+            default=0,
+        )
+
+    def start(self):
+        self._event = asyncio.Event()
+        for index, counter in enumerate(self.counters):
+
+            def update(value, index=index):
+                self._update(index, value)
+
+            counter.subscribe_value(update)
+            self._callbacks.append(update)
+
+    def stop(self):
+        for counter, update in zip(self.counters, self._callbacks):
+            counter.clear_sub(update)
+        self._callbacks.clear()
+        if self._waiter is not None:
+            self._waiter.cancel()
+            self._waiter = None
+
+    def watch(self, status):
+        """Also wake when status finishes"""
+        status.add_callback(lambda _: self._event.set())
+
+    async def _wait(self):
+        await self._event.wait()
+        # A finished status sets the event once, leaving it set would make
+        # every later wait return at once until the next reset
+        self._event.clear()
+
+    def wait(self):
+        """Future that completes on the next wake, for use with bps.wait_for"""
+        if self._waiter is None or self._waiter.done():
+            self._waiter = asyncio.ensure_future(self._wait())
+        return self._waiter
+
+    def reset(self):
+        """Mark everything seen so far as collected"""
+        self.collected = list(self.totals)
+        self._event.clear()
+
+
+def _collect(collectables, stream):
+    for collectable in collectables:
+        # The RunEngine only streams events, pages are always emitted whole
+        pages = isinstance(collectable, EventPageCollectable)
+        # Each goes to a stream named after it, which stream_resource
+        # documents need to find the descriptor of their data keys
+        yield from bps.collect(
+            collectable,
+            stream=stream and not pages,
+            return_payload=False,
+            name=collectable.name,
+        )
+
+
+def _wait(watcher, timeout):
+    """Plan stub waiting for the next wake of watcher for up to timeout
+
+    The timeout is applied inside the awaitable so that running out of time
+    returns normally, bps.wait_for's own timeout raises WaitForTimeoutError.
+    """
+
+    def wait():
+        return asyncio.ensure_future(asyncio.wait([watcher.wait()], timeout=timeout))
+
+    yield from bps.wait_for([wait])
+
+
+def collect_while_completing(
+    statuses, collectables, counters, frames=100, max_latency=1.0, stream=True
+):
+    """Collect from collectables until all statuses are done, then once more
+
+    A collect is triggered whenever frames new frames have been counted on any
+    of counters, or max_latency seconds have passed since the last collect.
+    The final collect after the statuses are done flushes anything left. Each
+    collectable is collected into a stream named after it.
+    """
+    watcher = FrameWatcher(counters, frames)
+    watcher.start()
+    try:
+        statuses = [status for status in statuses if status is not None]
+        for status in statuses:
+            watcher.watch(status)
+        last = monotonic()
+        while not all(status.done for status in statuses):
+            remaining = max_latency - (monotonic() - last)
+            if remaining > 0 and watcher.pending() < frames:
+                yield from _wait(watcher, remaining)
+            if watcher.pending() or monotonic() - last >= max_latency:
+                watcher.reset()
+                yield from _collect(collectables, stream)
+                last = monotonic()
+        yield from _collect(collectables, stream)
+    finally:
+        watcher.stop()
+
+
+class _Counter:
+    def __init__(self):
+        self.subs = []
+
+    def subscribe_value(self, function):
+        self.subs.append(function)
+        function(0)
+
+    def clear_sub(self, function):
+        self.subs.remove(function)
+
+    def update(self, value):
+        for function in self.subs:
+            function(value)
+
+
+def test_frame_watcher():
+    async def run():
+        det, panda = _Counter(), _Counter()
+        watcher = FrameWatcher([det, panda], frames=10)
+        watcher.start()
+        waiter = watcher.wait()
+        det.update(5)
+        panda.update(8)
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        panda.update(12)
+        await asyncio.wait_for(waiter, 1)
+        assert watcher.pending() == 12
+        # Each wake is consumed, the next wait blocks until something new
+        waiter = watcher.wait()
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        waiter.cancel()
+        watcher.reset()
+        assert watcher.pending() == 0
+        det.update(6)
+        assert watcher.pending() == 1
+        watcher.stop()
+        assert det.subs == [] and panda.subs == []
+
+    asyncio.run(run())
+
+
+def test_collect_while_completing_slow():
+    from bluesky import RunEngine
+    from bluesky import preprocessors as bpp
+    from ophyd.v2.core import AsyncStatus
+
+    class Source:
+        def __init__(self, name):
+            self.name = name
+            self.collects = 0
+
+        def describe_collect(self):
+            key = {"source": "sim", "dtype": "number", "shape": []}
+            return {self.name: {f"{self.name}-value": key}}
+
+    class Events(Source):
+        def collect(self):
+            self.collects += 1
+            yield from ()
+
+    class Pages(Source):
+        def collect_pages(self):
+            self.collects += 1
+            yield from ()
+
+    counter, source, pages = _Counter(), Events("events"), Pages("pages")
+
+    async def fly():
+        for value in range(1, 6):
+            await asyncio.sleep(0.05)
+            counter.update(value)
+
+    @bpp.run_decorator()
+    def plan():
+        status = AsyncStatus(fly())
+        # Far fewer than frames arrive, so every collect is on max_latency
+        yield from collect_while_completing(
+            [status], [source, pages], [counter], frames=100, max_latency=0.1
+        )
+
+    RunEngine()(plan())
+    assert 2 <= source.collects <= 5
+    assert pages.collects == source.collects
+    assert counter.subs == []
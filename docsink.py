@@ -0,0 +1,210 @@
+"""Bounded, incremental storage of bluesky documents on disk
+
+DocumentSink is a RunEngine callback that puts (name, doc) pairs on a bounded
+queue drained by a writer thread, so a long scan keeps a fixed amount of
+documents in memory and everything written survives the session ending.
+Documents are stored as length prefixed msgpack records with a separate index
+of record offsets, which DocumentReader uses to seek to any document without
+reading the ones before it.
+
+    RE(plan(), DocumentSink("scan.docs"))
+    docs = DocumentReader("scan.docs")
+    name, doc = docs[-1]
+"""
+
+import mmap
+import queue
+import struct
+import threading
+from pathlib import Path
+
+import msgpack
+import numpy as np
+
+_LENGTH = struct.Struct("<I")
+_OFFSET = np.dtype("<u8")
+_OFFSET_RECORD = struct.Struct("<Q")
+
+DROPPABLE = frozenset({"event", "event_page"})
+"""Documents that may be dropped by the 'drop' policy
+
+Run start/stop, descriptors and resources are always kept as without them the
+remaining documents can't be interpreted.
+"""
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f"Can't serialize {type(obj).__name__}")
+
+
+def index_path(path):
+    path = Path(path)
+    return path.with_name(path.name + ".idx")
+
+
+class DocumentSink:
+    """RunEngine callback writing documents to path from a background thread
+
+    If the writer falls behind by more than maxsize documents, policy decides
+    what happens: 'block' holds up the caller until there is space, 'drop'
+    discards DROPPABLE documents (counting them in dropped) and blocks for the
+    rest.
+    """
+
+    def __init__(self, path, maxsize=1000, policy="block", flush_every=100):
+        if policy not in ("block", "drop"):
+            raise ValueError(f"Unknown policy {policy!r}")
+        self.path = Path(path)
+        self.policy = policy
+        self.flush_every = flush_every
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def __call__(self, name, doc):
+        self._check()
+        if self.policy == "drop" and name in DROPPABLE:
+            try:
+                self._queue.put_nowait((name, doc))
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self._queue.put((name, doc))
+
+    def _write(self):
+        packer = msgpack.Packer(default=_default)
+        try:
+            with open(self.path, "wb") as data, open(
+                index_path(self.path), "wb"
+            ) as index:
+                while True:
+                    item = self._queue.get()
+                    if item is None:
+                        break
+                    record = packer.pack(item)
+                    index.write(_OFFSET_RECORD.pack(data.tell()))
+                    data.write(_LENGTH.pack(len(record)))
+                    data.write(record)
+                    self.written += 1
+                    if self.written % self.flush_every == 0 or self._queue.empty():
+                        data.flush()
+                        index.flush()
+        except Exception as e:
+            self.error = e
+            # Keep draining so that callers blocked on a full queue are released
+            while self._queue.get() is not None:
+                pass
+
+    def close(self):
+        """Write any queued documents and stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            message = f"Writing documents to {self.path} failed"
+            raise RuntimeError(message) from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DocumentReader:
+    """Lazy, random access reader for files written by DocumentSink
+
+    The data file is memory mapped and documents are only unpacked when they
+    are accessed. If the index is missing (eg the session died before it was
+    flushed) it is rebuilt by scanning the record lengths.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._map = b""
+        if self.path.stat().st_size:
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = self._load_index()
+
+    def _load_index(self):
+        try:
+            offsets = np.fromfile(index_path(self.path), _OFFSET)
+        except FileNotFoundError:
+            offsets = np.zeros(0, _OFFSET)
+        # Drop entries for records that were not completely written and
+        # pick up any written after the index was last flushed
+        offsets = offsets[offsets + _LENGTH.size <= len(self._map)]
+        found = list(offsets[:-1])
+        position = int(offsets[-1]) if len(offsets) else 0
+        while position + _LENGTH.size <= len(self._map):
+            (length,) = _LENGTH.unpack_from(self._map, position)
+            if position + _LENGTH.size + length > len(self._map):
+                break
+            found.append(position)
+            position += _LENGTH.size + length
+        return np.array(found, _OFFSET)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        position = int(self.offsets[index])
+        (length,) = _LENGTH.unpack_from(self._map, position)
+        start = position + _LENGTH.size
+        name, doc = msgpack.unpackb(self._map[start : start + length])
+        return name, doc
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def names(self):
+        return [name for name, _ in self]
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+def test_document_sink(tmp_path):
+    path = tmp_path / "run.docs"
+    with DocumentSink(path, maxsize=2) as sink:
+        sink("start", {"uid": "abc"})
+        for i in range(20):
+            sink("event", {"data": {"x": np.float64(i)}, "seq_num": i + 1})
+        sink("event_page", {"data": {"x": np.arange(3)}})
+        sink("stop", {"exit_status": "success"})
+    assert sink.written == 23
+    docs = DocumentReader(path)
+    assert len(docs) == 23
+    assert docs[0] == ("start", {"uid": "abc"})
+    assert docs[5][1]["data"]["x"] == 4.0
+    assert docs[-2][1]["data"]["x"] == [0, 1, 2]
+    assert docs.names()[-1] == "stop"
+    docs.close()
+
+    # A lost index is rebuilt from the data
+    index_path(path).write_bytes(b"")
+    assert len(DocumentReader(path)) == 23
+
+
+def test_document_sink_drop(tmp_path):
+    sink = DocumentSink(tmp_path / "run.docs", maxsize=1, policy="drop")
+    sink._queue.put(("start", {}))
+    sink._queue.put(("start", {}))
+    for _ in range(100):
+        sink("event", {})
+    sink.close()
+    assert sink.written + sink.dropped == 102
@@ -0,0 +1,202 @@
+"""Cached figlet rendering of text as arrays of bits
+
+Loading a figlet font is slow compared to the rest of the table generation so
+fonts are loaded once and each character's glyph is kept as a numpy array.
+Text is then rendered by joining cached glyphs, following the same layout
+rules as pyfiglet for full width and kerned fonts. Fonts that smush characters
+together are rendered by pyfiglet directly.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# pyfiglet is slow to import so it is only imported when text is first
+# rendered, keeping imports of this module (and tables) fast
+
+SPACE = 0
+INK = 1
+HARDBLANK = 2
+
+SM_KERN = 64
+SM_SMUSH = 128
+
+
+def _codes(rows, hard_blank):
+    """Convert the rows of a figlet character into SPACE/INK/HARDBLANK codes"""
+    width = max((len(row) for row in rows), default=0)
+    codes = np.full((len(rows), width), SPACE, dtype=np.uint8)
+    for codes_row, row in zip(codes, rows):
+        for i, c in enumerate(row):
+            if c == hard_blank:
+                codes_row[i] = HARDBLANK
+            elif c != " ":
+                codes_row[i] = INK
+    return codes
+
+
+def _trailing_spaces(codes):
+    if not codes.shape[1]:
+        return np.zeros(len(codes), dtype=int)
+    ink = codes[:, ::-1] != SPACE
+    return np.where(ink.any(axis=1), ink.argmax(axis=1), codes.shape[1])
+
+
+def _leading_spaces(codes):
+    if not codes.shape[1]:
+        return np.zeros(len(codes), dtype=int)
+    ink = codes != SPACE
+    return np.where(ink.any(axis=1), ink.argmax(axis=1), codes.shape[1])
+
+
+def _kern(buffer, glyph):
+    """Join glyph onto buffer, overlapping as many blank columns as possible"""
+    overlap = (_trailing_spaces(buffer) + _leading_spaces(glyph)).min()
+    overlap = min(overlap, glyph.shape[1])
+    start = buffer.shape[1] - overlap
+    if start < 0:
+        glyph = glyph[:, -start:]
+        start = 0
+    joined = np.zeros((len(buffer), start + glyph.shape[1]), dtype=np.uint8)
+    joined[:, : buffer.shape[1]] = buffer
+    joined[:, start:] = np.maximum(joined[:, start:], glyph)
+    return joined
+
+
+class GlyphCache:
+    """LRU cache of figlet glyphs keyed by font and character"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self._fonts = {}
+        self._glyphs = OrderedDict()
+
+    def font(self, name):
+        """Load (once) and return the named FigletFont"""
+        if name not in self._fonts:
+            from pyfiglet import FigletFont
+
+            self._fonts[name] = FigletFont(font=name)
+        return self._fonts[name]
+
+    def glyph(self, font, char):
+        """Codes for a single character or None if the font does not have it"""
+        key = (font, char)
+        if key in self._glyphs:
+            self.hits += 1
+            self._glyphs.move_to_end(key)
+            return self._glyphs[key]
+        self.misses += 1
+        fnt = self.font(font)
+        rows = fnt.chars.get(ord(char))
+        glyph = None if rows is None else _codes(rows, fnt.hardBlank)
+        self._glyphs[key] = glyph
+        if len(self._glyphs) > self.maxsize:
+            self._glyphs.popitem(last=False)
+        return glyph
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+            "size": len(self._glyphs),
+            "maxsize": self.maxsize,
+            "fonts": len(self._fonts),
+        }
+
+    def clear(self):
+        self._glyphs.clear()
+        self.hits = self.misses = self.fallbacks = 0
+
+    def render(self, text, font="clr6x6", width=80):
+        """Render text to a list of bit arrays, one per line of figlet output
+
+        The output matches Figlet(font, width=width).renderText(text).splitlines()
+        with spaces (and hard blanks) as 0 and everything else as 1.
+        """
+        from pyfiglet import CharNotPrinted, Figlet
+
+        fnt = self.font(font)
+        if fnt.smushMode & SM_SMUSH or fnt.printDirection == 1:
+            self.fallbacks += 1
+            lines = Figlet(font=font, width=width).renderText(text).splitlines()
+            return [np.array([c != " " for c in ln], dtype=np.uint8) for ln in lines]
+        kern = fnt.smushMode & SM_KERN
+        empty = np.zeros((fnt.height, 0), dtype=np.uint8)
+        blocks = []
+        buffer = empty
+        blanks = []
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if char == "\n":
+                blanks.append((buffer, i))
+                wrap = True
+            else:
+                glyph = self.glyph(font, char)
+                if glyph is None:
+                    i += 1
+                    continue
+                if width < glyph.shape[1]:
+                    raise CharNotPrinted("Width is not enough to print this character")
+                if char == " ":
+                    blanks.append((buffer, i))
+                joined = _kern(buffer, glyph) if kern else np.hstack((buffer, glyph))
+                wrap = joined.shape[1] >= width
+            if wrap:
+                # Break at the last blank if there is one, otherwise retry
+                # this character on a new line, as pyfiglet does
+                if blanks:
+                    saved, i = blanks.pop()
+                    blocks.append(saved)
+                elif not buffer.shape[1]:
+                    # pyfiglet would retry this character forever
+                    raise CharNotPrinted("Width is not enough to print this character")
+                else:
+                    blocks.append(buffer)
+                    i -= 1
+                buffer = empty
+                blanks = []
+            else:
+                buffer = joined
+            i += 1
+        if buffer.shape[1]:
+            blocks.append(buffer)
+        return [(row == INK).astype(np.uint8) for block in blocks for row in block]
+
+
+glyph_cache = GlyphCache()
+"""Cache shared by everything rendering figlet text in this process"""
+
+
+def render(text, font="clr6x6", width=80):
+    """Render text using the shared glyph cache"""
+    return glyph_cache.render(text, font, width)
+
+
+def test_render_matches_figlet():
+    from pyfiglet import Figlet
+
+    cache = GlyphCache()
+    texts = ("abc", "helloWorld", "hello world, again", "a\nbc", " x ", "", "é~")
+    for font in ("clr6x6", "standard", "banner", "small"):
+        for text in texts:
+            for width in (20, 40, 80):
+                figlet = Figlet(font=font, width=width).renderText(text).splitlines()
+                expected = [[0 if c == " " else 1 for c in line] for line in figlet]
+                actual = [line.tolist() for line in cache.render(text, font, width)]
+                assert actual == expected, (font, text, width)
+
+
+def test_glyph_cache_stats():
+    cache = GlyphCache(maxsize=2)
+    cache.render("aab", "clr6x6", 80)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    cache.render("c", "clr6x6", 80)
+    assert cache.stats()["size"] == 2
+    assert ("clr6x6", "a") not in cache._glyphs
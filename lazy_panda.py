@@ -0,0 +1,303 @@
+"""PandA device built from a cached schema, connecting blocks on demand
+
+Connecting a PandA introspects every block and connects every signal, which
+dominates the time taken to bring up a session. The block and signal layout
+found by that introspection is saved to disk, keyed by IOC prefix and
+firmware version, and LazyPandA is built from it after reading only the
+firmware version from the IOC.
+Connecting a LazyPandA connects nothing: blocks are connected the first time
+they are needed with connect_blocks, or the ensure_blocks plan stub.
+
+    pnd = lazy_panda("TS-PANDA", firmware="3.0")
+    RE(ensure_blocks(pnd, "seq1"))
+"""
+
+import asyncio
+import json
+import os
+from functools import partial
+from pathlib import Path
+
+from ophyd.v2.core import (
+    Device,
+    NotConnected,
+    SignalR,
+    SignalRW,
+    SignalW,
+    get_device_children,
+)
+from ophyd.v2.epics import epics_signal_r, epics_signal_rw, epics_signal_w
+
+import startup
+
+CACHE_DIR = Path(
+    os.environ.get("PANDA_SCHEMA_CACHE", Path.home() / ".cache" / "panda_trials")
+)
+
+FIRMWARE = os.environ.get("PANDA_FIRMWARE", "unknown")
+"""Firmware version used when it cannot be read from the IOC"""
+
+FIRMWARE_PV = os.environ.get("PANDA_FIRMWARE_PV", ":FPGA")
+"""Suffix of the PV the IOC publishes the firmware version on"""
+
+
+def _datatypes():
+    # Only needed when a schema is built or loaded, not to import this module
+    from ophyd_epics_devices.panda import SeqTable
+
+    return {"int": int, "float": float, "str": str, "bool": bool, "SeqTable": SeqTable}
+
+
+def schema_path(prefix, firmware, cache_dir=None):
+    name = f"{prefix}-{firmware}.json".replace("/", "_").replace(":", "_")
+    return Path(cache_dir or CACHE_DIR) / name
+
+
+def _pv(source, pv):
+    """Prefix pv with the transport used in source, eg pva://"""
+    scheme, sep, _ = source.partition("://")
+    return f"{scheme}://{pv}" if sep and "://" not in pv else pv
+
+
+def _signal_schema(signal):
+    backend = signal._backend
+    datatype = getattr(backend, "datatype", None)
+    name = getattr(datatype, "__name__", None)
+    if isinstance(signal, SignalRW):
+        kind = "rw"
+    elif isinstance(signal, SignalW):
+        kind = "w"
+    else:
+        kind = "r"
+    read_pv = getattr(backend, "read_pv", None)
+    write_pv = getattr(backend, "write_pv", None)
+    return {
+        "kind": kind,
+        "read_pv": _pv(signal.source, read_pv) if read_pv else signal.source,
+        "write_pv": _pv(signal.source, write_pv) if write_pv else signal.source,
+        # Enums are read and written by name, anything else is left to the
+        # backend to work out from the PV
+        "datatype": name if name in _datatypes() else None,
+    }
+
+
+def discover_schema(pnd):
+    """Schema of the blocks and signals of a connected PandA"""
+    schema = {}
+    for block_name, block in get_device_children(pnd):
+        signals = {
+            name: _signal_schema(signal)
+            for name, signal in get_device_children(block)
+            if isinstance(signal, (SignalR, SignalW))
+        }
+        if signals:
+            schema[block_name] = signals
+    return schema
+
+
+async def read_firmware(prefix, timeout=2.0):
+    """Firmware version reported by the IOC, or $PANDA_FIRMWARE if unreadable"""
+    version = epics_signal_r(str, prefix + FIRMWARE_PV)
+    try:
+        await asyncio.wait_for(version.connect(), timeout)
+        return await asyncio.wait_for(version.get_value(), timeout) or FIRMWARE
+    except (asyncio.TimeoutError, NotConnected):
+        return FIRMWARE
+
+
+async def load_schema(prefix, firmware, cache_dir=None, refresh=False):
+    """Schema for a PandA, from the cache or by introspecting the IOC"""
+    path = schema_path(prefix, firmware, cache_dir)
+    if path.exists() and not refresh:
+        with startup.timer("load PandA schema"):
+            return json.loads(path.read_text())
+    with startup.timer("introspect PandA"):
+        from ophyd_epics_devices.panda import PandA
+
+        pnd = PandA(prefix)
+        await pnd.connect()
+        schema = discover_schema(pnd)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(schema, indent=1))
+    return schema
+
+
+def _make_signal(spec, datatypes):
+    datatype = datatypes.get(spec["datatype"])
+    if spec["kind"] == "rw":
+        return epics_signal_rw(datatype, spec["read_pv"], spec["write_pv"])
+    if spec["kind"] == "w":
+        return epics_signal_w(datatype, spec["write_pv"])
+    return epics_signal_r(datatype, spec["read_pv"])
+
+
+class LazyBlock(Device):
+    def __init__(self, signals, datatypes, name=""):
+        for signal_name, spec in signals.items():
+            setattr(self, signal_name, _make_signal(spec, datatypes))
+        self.connected = False
+        super().__init__(name=name)
+
+
+class LazyPandA(Device):
+    """PandA whose blocks are only connected when asked for
+
+    connect records the connection options and returns immediately. Each
+    block is connected on the first connect_blocks call that names it.
+    """
+
+    def __init__(self, schema, name=""):
+        datatypes = _datatypes()
+        for block_name, signals in schema.items():
+            setattr(self, block_name, LazyBlock(signals, datatypes))
+        self._sim = False
+        self._connecting = {}
+        super().__init__(name=name)
+
+    async def connect(self, sim=False):
+        self._sim = sim
+
+    async def _connect_block(self, name):
+        block = getattr(self, name)
+        with startup.timer(f"connect {self.name}.{name}"):
+            await block.connect(sim=self._sim)
+        block.connected = True
+
+    def _forget_failed(self, name, future):
+        # Runs before the caller sees the error, so the next call retries
+        if future.cancelled() or future.exception() is not None:
+            if self._connecting.get(name) is future:
+                del self._connecting[name]
+
+    async def connect_blocks(self, *names):
+        """Connect the named blocks, if they are not already connected
+
+        A block that fails to connect is tried again on the next call.
+        """
+        for name in names:
+            if name not in self._connecting:
+                future = asyncio.ensure_future(self._connect_block(name))
+                future.add_done_callback(partial(self._forget_failed, name))
+                self._connecting[name] = future
+        await asyncio.gather(*(self._connecting[name] for name in names))
+
+
+async def connect_blocks_for(pnd, *names):
+    """Connect the named blocks if pnd is a LazyPandA"""
+    if isinstance(pnd, LazyPandA):
+        await pnd.connect_blocks(*names)
+
+
+async def connect_blocks_of(*blocks):
+    """Connect blocks (eg pnd.seq1) that belong to a LazyPandA
+
+    For code that is handed blocks rather than the PandA they are part of.
+    """
+    connects = []
+    for block in blocks:
+        if isinstance(block.parent, LazyPandA):
+            connects += [
+                block.parent.connect_blocks(name)
+                for name, child in get_device_children(block.parent)
+                if child is block
+            ]
+    await asyncio.gather(*connects)
+
+
+def ensure_blocks(pnd, *names):
+    """Plan stub connecting the named blocks of a LazyPandA before use
+
+    Does nothing for devices that are not lazy, so plans can use it with
+    either kind of PandA. Raises the error of a block that fails to connect.
+    """
+    from stubs import await_coroutine
+
+    if isinstance(pnd, LazyPandA):
+        yield from await_coroutine(pnd.connect_blocks, *names)
+
+
+def lazy_panda(prefix, name="pnda", firmware=None, refresh=False):
+    """Create a LazyPandA for prefix from its cached schema
+
+    The schema is only introspected from the IOC if it is not cached for this
+    prefix and firmware version (or if refresh is set). The firmware version
+    is read from the IOC unless given, falling back to $PANDA_FIRMWARE if it
+    cannot be read; set refresh after upgrading the firmware in that case.
+    """
+    from bluesky.run_engine import call_in_bluesky_event_loop
+
+    async def schema():
+        with startup.timer("read PandA firmware"):
+            version = firmware or await read_firmware(prefix)
+        return await load_schema(prefix, version, refresh=refresh)
+
+    with startup.timer(f"create {name}"):
+        schema = call_in_bluesky_event_loop(schema())
+        return LazyPandA(schema, name=name)
+
+
+def test_lazy_panda(tmp_path):
+    schema = {
+        "seq1": {
+            "table": {
+                "kind": "rw",
+                "read_pv": "pva://SIM:SEQ1:TABLE",
+                "write_pv": "pva://SIM:SEQ1:TABLE",
+                "datatype": "SeqTable",
+            },
+            "active": {
+                "kind": "r",
+                "read_pv": "SIM:SEQ1:ACTIVE",
+                "write_pv": "SIM:SEQ1:ACTIVE",
+                "datatype": "str",
+            },
+        },
+        "pcap": {
+            "arm": {
+                "kind": "rw",
+                "read_pv": "SIM:PCAP:ARM",
+                "write_pv": "SIM:PCAP:ARM",
+                "datatype": None,
+            }
+        },
+    }
+    path = schema_path("SIM", "1.0", tmp_path)
+    path.write_text(json.dumps(schema))
+
+    async def run():
+        assert await load_schema("SIM", "1.0", tmp_path) == schema
+        pnd = LazyPandA(schema, name="pnd")
+        await pnd.connect(sim=True)
+        assert not pnd.seq1.connected
+        await pnd.connect_blocks("seq1")
+        assert pnd.seq1.connected and not pnd.pcap.connected
+        assert await pnd.seq1.active.get_value() == ""
+        assert discover_schema(pnd)["seq1"]["active"]["kind"] == "r"
+        await connect_blocks_of(pnd.pcap)
+        assert pnd.pcap.connected
+
+    asyncio.run(run())
+
+
+def test_connect_blocks_retries_failed():
+    from bluesky import RunEngine
+
+    pnd = LazyPandA({"seq1": {}}, name="pnd")
+    attempts = []
+
+    async def connect(sim=False):
+        attempts.append(sim)
+        if len(attempts) == 1:
+            raise NotConnected("seq1")
+
+    pnd.seq1.connect = connect
+    RE = RunEngine()
+    try:
+        RE(ensure_blocks(pnd, "seq1"))
+    except NotConnected:
+        pass
+    else:
+        raise AssertionError("the connect error was not raised")
+    assert not pnd.seq1.connected
+    RE(ensure_blocks(pnd, "seq1"))
+    assert pnd.seq1.connected and len(attempts) == 2
@@ -1,4 +1,9 @@
-from ophyd.v2.core import Device
+import asyncio
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+from bluesky.protocols import Descriptor, Flyable, PartialEventPage
+from ophyd.v2.core import AsyncStatus, Device, set_sim_value
 from ophyd.v2.epics import epics_signal_rw, epics_signal_r
 
 
@@ -14,3 +19,269 @@ class Linkam(Device):
         self.ramp_time = epics_signal_r(float, base_pv + ":RAMPTIME")
         self.start_heat = epics_signal_rw(float, base_pv + ":STARTHEAT")
         self.dsc = epics_signal_r(bool, base_pv + ":DSC")
+
+
+RECORDED = ("temp", "set_point", "dsc")
+
+
+class SeriesBuffer:
+    """Timestamped samples in preallocated columns, doubled in size when full
+
+    If bin_seconds is given, samples are decimated as they arrive: each row
+    holds the min, max and mean of every column over one bin of time,
+    timestamped with the start of the bin, so memory grows with the length of
+    the ramp in bins rather than in samples.
+    """
+
+    def __init__(self, names=RECORDED, chunk=4096, bin_seconds=None):
+        self.names = tuple(names)
+        self.chunk = chunk
+        self.bin_seconds = bin_seconds
+        if bin_seconds is None:
+            self.columns = self.names
+        else:
+            self.columns = tuple(
+                f"{name}_{stat}"
+                for name in self.names
+                for stat in ("min", "max", "mean")
+            )
+        self.dtype = np.dtype(
+            [("time", np.float64)] + [(c, np.float64) for c in self.columns]
+        )
+        self._data = np.zeros(chunk, self.dtype)
+        self._len = 0
+        self.samples = 0
+        self._bin = None
+        self._count = 0
+        self._stats = None
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def data(self):
+        """View of the rows so far, not including a partly filled bin"""
+        return self._data[: self._len]
+
+    def _append(self, row):
+        if self._len == len(self._data):
+            data = np.zeros(2 * len(self._data) or self.chunk, self.dtype)
+            data[: self._len] = self._data
+            self._data = data
+        self._data[self._len] = row
+        self._len += 1
+
+    def append(self, timestamp, values):
+        """Add a sample of every column (in names order) taken at timestamp"""
+        self.samples += 1
+        if self.bin_seconds is None:
+            self._append((timestamp, *values))
+            return
+        start = timestamp - timestamp % self.bin_seconds
+        if start != self._bin:
+            self.flush()
+            self._bin = start
+            self._count = 0
+            values = np.asarray(values, dtype=np.float64)
+            self._stats = np.stack([values, values, np.zeros_like(values)])
+        self._count += 1
+        self._stats[0] = np.minimum(self._stats[0], values)
+        self._stats[1] = np.maximum(self._stats[1], values)
+        self._stats[2] += values
+
+    def flush(self):
+        """Write out the partly filled bin, if there is one"""
+        if self._count:
+            stats = self._stats.copy()
+            stats[2] /= self._count
+            self._append((self._bin, *stats.T.ravel()))
+        self._count = 0
+        self._bin = None
+
+    def pop(self):
+        """Remove and return all complete rows"""
+        rows = self.data.copy()
+        self._len = 0
+        return rows
+
+    def interpolate(self, times, column):
+        """Value of column at each of times (eg PandA capture timestamps)"""
+        return np.interp(times, self.data["time"], self.data[column])
+
+
+class LinkamRecorder(Flyable):
+    """Record a Linkam ramp from monitors on temp, set_point and dsc
+
+    Each monitor update records a row of the latest value of every signal,
+    timestamped by the IOC. kickoff starts recording, complete waits for the
+    temperature to be within tolerance of the set point and stops it. The
+    temperature only counts as settled once the ramp has started, that is once
+    it has been out of tolerance or the set point has moved since kickoff, so
+    a recorder kicked off before the new set point is written does not stop
+    straight away. complete raises TimeoutError if the temperature has not
+    settled within fly_timeout seconds (or the timeout given to it).
+    """
+
+    def __init__(
+        self,
+        linkam: Linkam,
+        name="linkam",
+        tolerance=0.5,
+        fly_timeout=3600.0,
+        **buffer,
+    ):
+        self.dev = linkam
+        self._name = name
+        self.tolerance = tolerance
+        self.fly_timeout = fly_timeout
+        self.buffer = SeriesBuffer(RECORDED, **buffer)
+        self._latest = {}
+        self._callbacks = {}
+        self._settled = None
+        self._initial = None
+        self._ramping = False
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def _signal(self, name):
+        return getattr(self.dev, name)
+
+    def _update(self, name, reading):
+        (reading,) = reading.values()
+        self._latest[name] = float(reading["value"])
+        if len(self._latest) == len(RECORDED):
+            self.buffer.append(
+                reading["timestamp"], [self._latest[n] for n in RECORDED]
+            )
+            set_point = self._latest["set_point"]
+            if self._initial is None:
+                self._initial = set_point
+            error = self._latest["temp"] - set_point
+            if abs(error) > self.tolerance or set_point != self._initial:
+                self._ramping = True
+            if self._ramping and abs(error) <= self.tolerance:
+                self._settled.set()
+            else:
+                self._settled.clear()
+
+    @AsyncStatus.wrap
+    async def kickoff(self) -> None:
+        self._latest.clear()
+        self._settled = asyncio.Event()
+        self._initial = None
+        self._ramping = False
+        for name in RECORDED:
+
+            def update(reading, name=name):
+                self._update(name, reading)
+
+            self._signal(name).subscribe(update)
+            self._callbacks[name] = update
+
+    def _stop(self):
+        for name, update in self._callbacks.items():
+            self._signal(name).clear_sub(update)
+        self._callbacks.clear()
+        self.buffer.flush()
+
+    def complete(self, timeout: Optional[float] = None) -> AsyncStatus:
+        # Not AsyncStatus.wrap, which does not pass arguments on
+        timeout = self.fly_timeout if timeout is None else timeout
+        return AsyncStatus(self._complete(timeout))
+
+    async def _complete(self, timeout):
+        try:
+            await asyncio.wait_for(self._settled.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                f"{self.name} did not settle within {timeout}s"
+            ) from None
+        finally:
+            self._stop()
+
+    def collect_pages(self) -> Iterator[PartialEventPage]:
+        rows = self.buffer.pop()
+        if len(rows):
+            keys = [f"{self.name}-{c}" for c in self.buffer.columns]
+            yield {
+                "time": rows["time"],
+                "data": {k: rows[c] for k, c in zip(keys, self.buffer.columns)},
+                "timestamps": {k: rows["time"] for k in keys},
+            }
+
+    def _recorded(self, column):
+        """Name of the signal a buffer column was recorded from"""
+        return column.rsplit("_", 1)[0] if self.buffer.bin_seconds else column
+
+    def describe_collect(self) -> Dict[str, Dict[str, Descriptor]]:
+        return {
+            self.name: {
+                f"{self.name}-{column}": {
+                    "source": self._signal(self._recorded(column)).source,
+                    "dtype": "number",
+                    "shape": [],
+                }
+                for column in self.buffer.columns
+            }
+        }
+
+
+def test_series_buffer_decimation():
+    buffer = SeriesBuffer(("a", "b"), chunk=2, bin_seconds=1.0)
+    for t, a in ((0.1, 1.0), (0.5, 3.0), (0.9, 2.0), (1.2, 5.0), (2.5, 0.0)):
+        buffer.append(t, [a, -a])
+    buffer.flush()
+    assert buffer.samples == 5
+    assert buffer.data["time"].tolist() == [0.0, 1.0, 2.0]
+    assert buffer.data["a_min"].tolist() == [1.0, 5.0, 0.0]
+    assert buffer.data["b_min"].tolist() == [-3.0, -5.0, 0.0]
+    assert buffer.data["a_mean"].tolist() == [2.0, 5.0, 0.0]
+    raw = SeriesBuffer(("a",), chunk=2)
+    for t in range(5):
+        raw.append(float(t), [t * 2.0])
+    assert raw.interpolate([1.5], "a").tolist() == [3.0]
+    assert len(raw.pop()) == 5 and len(raw) == 0
+    assert len(raw._data) == 8
+
+
+def test_linkam_recorder():
+    async def run():
+        linkam = Linkam("SIM-LINKAM")
+        await linkam.connect(sim=True)
+        recorder = LinkamRecorder(linkam)
+        set_sim_value(linkam.set_point, 50.0)
+        await recorder.kickoff()
+        for temp in (20.0, 30.0, 40.0, 49.8):
+            set_sim_value(linkam.temp, temp)
+        await asyncio.wait_for(recorder.complete(), 1)
+        (page,) = recorder.collect_pages()
+        assert page["data"]["linkam-temp"][-4:].tolist() == [20.0, 30.0, 40.0, 49.8]
+        assert set(recorder.describe_collect()["linkam"]) == {
+            "linkam-temp",
+            "linkam-set_point",
+            "linkam-dsc",
+        }
+
+        # Already at the set point, nothing is settled until the ramp starts
+        await recorder.kickoff()
+        status = recorder.complete()
+        await asyncio.sleep(0.01)
+        assert not status.done
+        set_sim_value(linkam.set_point, 60.0)
+        set_sim_value(linkam.temp, 60.2)
+        await asyncio.wait_for(status, 1)
+
+        # A ramp that never settles fails complete, and recording stops
+        await recorder.kickoff()
+        set_sim_value(linkam.set_point, 70.0)
+        try:
+            await recorder.complete(timeout=0.01)
+        except TimeoutError:
+            pass
+        else:
+            raise AssertionError("complete did not time out")
+        assert not recorder._callbacks
+
+    asyncio.run(run())
@@ -0,0 +1,183 @@
+"""Lightweight in-process counters and timing histograms
+
+Hot paths record into the shared registry:
+
+    with metrics.registry.timer("table_set_seconds"):
+        await seq.table.set(table)
+    metrics.registry.inc("tables_written")
+
+and the results can be read with snapshot(), written in the Prometheus text
+format with write_prometheus or appended to a JSONL trace with write_jsonl
+(read back with read_jsonl). Disabling a registry turns every call into an
+early return, so the instrumentation can be left in place.
+"""
+
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from time import perf_counter, time
+
+BUCKETS = tuple(float(f"{m}e{e}") for e in range(-6, 2) for m in (1, 2.5, 5))
+"""Upper bounds (seconds) of histogram buckets, 1us to 50s"""
+
+
+class Histogram:
+    """Counts of observations per bucket with their sum, Prometheus style"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q'th quantile"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(map(str, self.buckets + (float("inf"),)), self.counts)),
+        }
+
+
+class Metrics:
+    """Registry of named counters and histograms"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def _timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def timer(self, name):
+        """Context manager recording the time spent in it in histogram name"""
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "time": time(),
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: hist.snapshot() for name, hist in self.histograms.items()
+                },
+            }
+
+    def prometheus(self, prefix="panda_"):
+        """The current metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                lines.append(f"{prefix}{name} {value}")
+            for name, hist in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                cumulative = 0
+                bounds = [repr(b) for b in hist.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, hist.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{prefix}{name}_sum {hist.sum}")
+                lines.append(f"{prefix}{name}_count {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="panda_"):
+        """Write the metrics for a node exporter textfile collector"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmp, path)
+
+    def write_jsonl(self, path):
+        """Append a snapshot as one line of a JSONL trace"""
+        with open(path, "a") as f:
+            f.write(json.dumps(self.snapshot()) + "\n")
+
+
+def read_jsonl(path):
+    """Snapshots from a trace written by write_jsonl"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+registry = Metrics(enabled=os.environ.get("PANDA_METRICS", "1") != "0")
+"""Registry used by tables and panda_init, disabled by PANDA_METRICS=0"""
+
+
+def test_metrics(tmp_path):
+    metrics = Metrics()
+    with metrics.timer("build"):
+        pass
+    metrics.observe("build", 0.003)
+    metrics.inc("tables")
+    metrics.inc("rows", 100)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"tables": 1, "rows": 100}
+    assert snapshot["histograms"]["build"]["count"] == 2
+    assert snapshot["histograms"]["build"]["max"] == 0.003
+    text = metrics.prometheus()
+    assert 'panda_build_bucket{le="0.005"} 2' in text
+    assert "panda_rows 100" in text
+    metrics.write_jsonl(tmp_path / "trace.jsonl")
+    metrics.write_jsonl(tmp_path / "trace.jsonl")
+    assert len(read_jsonl(tmp_path / "trace.jsonl")) == 2
+    metrics.write_prometheus(tmp_path / "panda.prom")
+    assert (tmp_path / "panda.prom").read_text() == text
+
+    metrics.enabled = False
+    metrics.inc("tables")
+    with metrics.timer("build"):
+        pass
+    assert metrics.snapshot()["counters"]["tables"] == 1
@@ -1,8 +1,11 @@
 from ophyd_epics_devices.panda import PandA
-from ophyd.v2.core import DeviceCollector
-from ophyd_epics_devices.panda import PandA
+
+import startup
+from lazy_panda import lazy_panda
+
 
 def panda(name="pnda") -> PandA:
-    with DeviceCollector():
-        pnda = PandA("TS-PANDA")
+    # Blocks are connected by the plans that use them, see ensure_blocks
+    pnda = lazy_panda("TS-PANDA", name)
+    startup.report()
     return pnda
@@ -6,7 +6,21 @@ from collections import namedtuple
 import bluesky.plan_stubs as bps
 import numpy as np
 
-from pyfiglet import Figlet
+import glyphs
+import tables
+from lazy_panda import ensure_blocks
+from stubs import await_coroutine
+from table_store import TableStore
+
+_store = None
+
+
+def _table_store():
+    """TableStore for banners, only created when first used"""
+    global _store
+    if _store is None:
+        _store = TableStore()
+    return _store
 
 Frame = namedtuple('Frame', ("repeats", "trigger", "position", "time1", "outa1", "outb1", "outc1", "outd1", "oute1", "outf1", "time2", "outa2", "outb2", "outc2", "outd2", "oute2", "outf2"))
 
@@ -14,14 +28,19 @@ def frame(*, repeats=1, trigger="Immediate", position=0, time1=0, outa1=0, outb1
     return Frame(repeats, trigger, position, time1, outa1, outb1, outc1, outd1, oute1, outf1, time2, outa2, outb2, outc2, outd2, oute2, outf2)
 
 def render(txt, font='clr6x6', width=200):
-    f = Figlet(font=font, width=width)
-    lines = f.renderText(txt).splitlines()
-    return [[0 if c == ' ' else 1 for c in line] for line in lines]
+    return [line.tolist() for line in glyphs.render(txt, font, width)]
 
 def enable(state: bool, pnd: PandA = "pnda") -> MsgGenerator:
+    yield from ensure_blocks(pnd, "seq1")
     yield from bps.mov(pnd.seq1.enable, 'ONE' if state else 'ZERO')
 
 def configure_text(txt: str, pnd: PandA = "pnda", font: str ="clr6x6", start: int =600, step: int =8) -> MsgGenerator:
+    rows = _table_store().cached("configure_text", text_rows, txt, font, start, step)
+    yield from ensure_blocks(pnd, "seq1")
+    yield from bps.mov(pnd.seq1.table, rows.to_table())
+
+def text_rows(txt, font="clr6x6", start=600, step=8):
+    """FrameBuffer of the table showing txt as the position falls from start"""
     text_frames = zip(*render(txt, font, width=start//step)[::-1])
     posn = start
     frames = []
@@ -29,9 +48,38 @@ def configure_text(txt: str, pnd: PandA = "pnda", font: str ="clr6x6", start: in
     for (a, b, c, d, e, f, *_) in text_frames:  # type: ignore mypy can't count to 6
         frames.append(frame(trigger="POSA<=POSITION", position=posn, outa2=a, outb2=b, outc2=c, outd2=d, oute2=e, outf2=f))
         posn -= step
-    yield from panda_frames(pnd, frames)
+    return tables.FrameBuffer.from_frames(frames)
+
+def stream_text(txt: str, pnd: PandA = "pnda", start: int = 600, step: int = 8, chunk: int = 100, timeout: float = 60.0) -> MsgGenerator:
+    """Scroll txt once across the display, streaming tables as they are needed
+
+    Tables are built a chunk at a time from the text as it is rendered and
+    each is written once the sequencer has swapped in the one before, so
+    memory use does not depend on the length of the text. Raises
+    asyncio.TimeoutError if the sequencer takes more than timeout seconds to
+    swap in a table.
+    """
+    yield from ensure_blocks(pnd, "seq1")
+    columns = tables.render_columns(txt)
+    chunks = tables.stream_chunks(columns, start // step, chunk, start, step)
+    first = next(chunks, None)
+    if first is None:
+        return
+    yield from bps.mov(pnd.seq1.table, first.to_table())
+    yield from bps.mov(pnd.seq1.enable, 'ONE')
+    for rows in chunks:
+        yield from _set_next_table(pnd.seq1, rows.to_table(), timeout)
+    # Hold the outputs low with the stop table until disabled, so the swap is
+    # seen even though the table takes no time
+    yield from _set_next_table(pnd.seq1, build_table(*zip(frame(repeats=0))), timeout)
+    yield from bps.mov(pnd.seq1.enable, 'ZERO')
+
+def _set_next_table(seq, table, timeout):
+    """Write table to a running seq and wait for the sequencer to take it"""
+    yield from await_coroutine(tables.set_next_table, seq, table, timeout)
 
 def panda_frames(pnd, frames):
+    yield from ensure_blocks(pnd, "seq1")
     table = build_table(*zip(*frames))
     yield from bps.mov(pnd.seq1.table, table)
 
@@ -1,105 +1,302 @@
+import asyncio
+import os
 from pathlib import Path
-from typing import Dict, Iterator
-
-import tables
-from bluesky import plan_stubs as bps
-from bluesky import plans as bp
-from bluesky import preprocessors as bpp
-from bluesky import Msg, RunEngine
-from bluesky.protocols import Descriptor, Flyable, PartialEvent, Readable
-from bluesky.run_engine import call_in_bluesky_event_loop
-from ophyd.v2.core import AsyncStatus, DeviceCollector, wait_for_value
-from ophyd_epics_devices.areadetector import (
-    ADDriver,
-    HDFStreamerDet,
-    NDFileHDF,
-    TmpDirectoryProvider,
-)
-from ophyd_epics_devices.panda import PandA
-
-
-class FlyingPanda(Flyable):
-    def __init__(self, panda):
+from time import perf_counter
+from typing import Dict, Iterator, Optional, Tuple
+
+import startup
+
+with startup.timer("imports"):
+    import metrics
+    import scan
+    import tables
+    from tables import TablePrefetcher
+    from collection import collect_while_completing
+    from stubs import await_coroutine
+    from docsink import DocumentReader, DocumentSink
+    from lazy_panda import connect_blocks_for, lazy_panda
+    from table_store import TableStore
+    from tetramm import Tetramm
+    from bluesky import plan_stubs as bps
+    from bluesky import preprocessors as bpp
+    from bluesky import RunEngine
+    from bluesky.protocols import Descriptor, Flyable, Stageable
+    from ophyd.v2.core import AsyncStatus, DeviceCollector, wait_for_value
+    from ophyd_epics_devices.areadetector import (
+        ADDriver,
+        HDFStreamerDet,
+        NDFileHDF,
+        TmpDirectoryProvider,
+    )
+
+
+class FlyingPanda(Flyable, Stageable):
+    def __init__(
+        self,
+        panda,
+        capture: Optional["PandaCapture"] = None,
+        swap_margin: float = 5.0,
+        fly_timeout: float = 60.0,
+    ):
         self.dev = panda
         self._frames = []
+        self.capture = capture
+        self.swap_margin = swap_margin
+        """Seconds allowed on top of a table's run time for the next swap"""
+        self.fly_timeout = fly_timeout
+        """Seconds complete waits for the remaining tables to be written"""
+        self._docs = None
+        self._remaining = None
+        self._running = 0.0
+        self._upload = None
 
     @property
     def name(self) -> str:
         return self.dev.name
 
     async def set_frames(self, frames):
-        table = tables.build_table(*zip(*frames))
-        await self.dev.seq1.tables.set(table)
+        with metrics.registry.timer("table_generation_seconds"):
+            table = tables.as_seq_table(frames)
+        with metrics.registry.timer("table_set_seconds"):
+            await self.dev.seq1.table.set(table)
+        self._running = tables.table_duration(table)
+        metrics.registry.inc("tables_written")
+        metrics.registry.inc("rows_written", len(table["REPEATS"]))
+
+    async def set_scan(self, chunks, prefetch=4):
+        """Write the first of chunks now and stream the rest during the fly"""
+        chunks = iter(chunks)
+        await self.set_frames(next(chunks))
+        self._remaining = TablePrefetcher(map(tables.as_seq_table, chunks), prefetch)
+
+    async def _upload_remaining(self):
+        async with self._remaining as src:
+            async for table in src:
+                # Waits for this table to be swapped in, not for a 1 that
+                # can_write_next may still show from before the write. That
+                # happens once the table running now has finished.
+                timeout = self._running + self.swap_margin
+                await tables.set_next_table(self.dev.seq1, table, timeout)
+                self._running = tables.table_duration(table)
+                metrics.registry.inc("tables_written")
+                metrics.registry.inc("rows_written", len(table["REPEATS"]))
+        self._remaining = None
 
     @AsyncStatus.wrap
     async def kickoff(self) -> None:
+        await connect_blocks_for(self.dev, "seq1")
+        if self.capture:
+            from pcap import StreamDocs
+
+            await self.capture.arm()
+            # The captured fields are known once armed, before any frames
+            self._docs = StreamDocs(
+                self.capture.writer, self.name, self.capture.fields
+            )
         await self.dev.seq1.enable.set("ONE")
         await wait_for_value(self.dev.seq1.active, "1", 5)
+        if self._remaining is not None:
+            self._upload = asyncio.get_running_loop().create_task(
+                self._upload_remaining()
+            )
 
     @AsyncStatus.wrap
     async def complete(self) -> None:
+        if self._upload is not None:
+            await asyncio.wait_for(self._upload, self.fly_timeout)
+            self._upload = None
         await wait_for_value(self.dev.seq1.active, "0", 20)
         await self.dev.seq1.enable.set("ZERO")
+        if self.capture:
+            await self.capture.disarm()
 
-    def collect(self) -> Iterator[PartialEvent]:
-        yield from iter([])
+    @AsyncStatus.wrap
+    async def stage(self) -> None:
+        await connect_blocks_for(self.dev, "seq1")
+
+    def unstage(self) -> AsyncStatus:
+        # The upload is cancelled before returning, as the RunEngine does not
+        # wait for unstage when cleaning up after a failed plan
+        if self._upload is not None:
+            self._upload.cancel()
+            self._upload = None
+        self._remaining = None
+        return AsyncStatus(self._stop())
+
+    async def _stop(self):
+        await self.dev.seq1.enable.set("ZERO")
+        if self.capture:
+            await self.capture.stop()
+
+    def collect_asset_docs(self) -> Iterator[Tuple[str, dict]]:
+        if self._docs:
+            yield from self._docs.documents()
 
     def describe_collect(self) -> Dict[str, Dict[str, Descriptor]]:
-        return {}
+        # Without a capture the stream is declared with no data keys, so the
+        # PandA can still be collected by name like the other flyers
+        if not self._docs:
+            return {self.name: {}}
+        return {self.name: self._docs.describe(f"panda://{self.capture.host}")}
 
 
-@bpp.run_decorator()
-def collect_n(det: HDFStreamerDet, panda: FlyingPanda, frames: int, tpf: int, expo: float):
-    yield from bps.mov(det.drv.acquire_time, expo, det.drv.num_images, frames)
+async def _timed(timings, name, setup):
+    start = perf_counter()
+    await setup()
+    timings[name] = perf_counter() - start
+    metrics.registry.observe(f"prepare_{name}_seconds", timings[name])
+
+
+async def _prepare_det(det, expo, frames):
+    await asyncio.gather(
+        det.drv.acquire_time.set(expo), det.drv.num_images.set(frames)
+    )
 
-    row = tables.frame(time1=tpf - 10, time2=10, outa2=1, repeats=frames)
-    yield from bps.mov(panda.dev.seq1.table, tables.build_table(*zip(*[row])))
 
-    yield Msg("stage", det)
+async def _prepare_panda(panda, chunks):
+    await connect_blocks_for(panda.dev, "seq1")
+    await panda.set_scan(chunks)
 
-    yield from bps.kickoff(det, wait=False, group="kick")
-    yield from bps.kickoff(panda, wait=False, group="kick")
+
+async def _prepare_tetramm(tetramm, frame_time, frames):
+    # One reading is taken per frame, complete waits for them all
+    tetramm.fly_readings = frames
+    await tetramm.set_frame_time(frame_time)
+
+
+def prepare(setups):
+    """Plan stub running {name: coroutine function} setups concurrently
+
+    Each setup is only called when the setups are run, so nothing is left
+    unawaited if the plan stops first, and the first setup to fail raises its
+    error in the plan. Returns how long each setup took, in seconds, by name.
+    """
+    timings = {}
+
+    async def run():
+        await asyncio.gather(
+            *(_timed(timings, name, setup) for name, setup in setups.items())
+        )
+
+    yield from await_coroutine(run)
+    return timings
+
+
+@bpp.run_decorator()
+def collect_n(
+    det: HDFStreamerDet,
+    panda: FlyingPanda,
+    frames: int,
+    tpf: int,
+    expo: float,
+    frames_per_page: int = 100,
+    max_latency: float = 1.0,
+    store: Optional[TableStore] = None,
+    tetramm: Optional[Tetramm] = None,
+    frame_time: Optional[float] = None,
+):
+    """Fly det and panda (and tetramm if given) for frames frames
+
+    Every device is configured at the same time and then staged at the same
+    time, so setup takes as long as the slowest device rather than the sum of
+    them all. The tetramm averages over frame_time seconds, expo if not given,
+    and complete waits for a reading of every frame.
+    """
+    columns = dict(time1=tpf - 10, time2=10, outa2=1)
+    if store is None:
+        chunks = scan.compile_scan(scan.point_blocks(frames, **columns))
+    else:
+        chunks = scan.cached_scan(store, frames, **columns)
+    setups = {
+        det.name: lambda: _prepare_det(det, expo, frames),
+        panda.name: lambda: _prepare_panda(panda, chunks),
+    }
+    flyers = [det, panda]
+    # The panda is unstaged to stop streaming tables if the plan fails
+    staged = [det, panda]
+    if tetramm is not None:
+        setups[tetramm.name] = lambda: _prepare_tetramm(
+            tetramm, frame_time or expo, frames
+        )
+        flyers.append(tetramm)
+        staged.append(tetramm)
+    timings = yield from prepare(setups)
+    # Staged through the RunEngine so it unstages them if the plan fails
+    start = perf_counter()
+    for device in staged:
+        yield from bps.stage(device, group="stage", wait=False)
+    yield from bps.wait(group="stage")
+    timings["stage"] = perf_counter() - start
+    metrics.registry.observe("prepare_stage_seconds", timings["stage"])
+    print("Prepared in " + ", ".join(f"{k}: {v:.3f}s" for k, v in timings.items()))
+
+    for flyer in flyers:
+        yield from bps.kickoff(flyer, wait=False, group="kick")
 
     yield from bps.wait(group="kick")
 
-    det_stat = yield from bps.complete(det, wait=False, group="complete")
-    panda_state = yield from bps.complete(panda, wait=False, group="complete")
+    statuses = []
+    for flyer in flyers:
+        status = yield from bps.complete(flyer, wait=False, group="complete")
+        statuses.append(status)
 
-    while det_stat and not det_stat.done:
-        yield from bps.sleep(1)
-        yield from bps.collect(det, stream=True, return_payload=False)
+    counters = [det.hdf.num_captured]
+    if panda.capture:
+        counters.append(panda.capture)
+    yield from collect_while_completing(
+        statuses, flyers, counters, frames_per_page, max_latency
+    )
     yield from bps.wait(group="complete")
 
-    yield Msg("unstage", det)
+    for device in staged:
+        yield from bps.unstage(device, group="unstage", wait=False)
+    yield from bps.wait(group="unstage")
 
 
-RE = RunEngine()
+with startup.timer("RunEngine"):
+    RE = RunEngine()
 
 d11_dir = TmpDirectoryProvider()
 d11_dir._directory = Path("/dls/tmp/qan22331/panda_ad")
 
-with DeviceCollector():
-    pnd = PandA("BL38P-PANDA")
+pnd = lazy_panda("BL38P-PANDA", "pnd")
+
+with startup.timer("connect detector"), DeviceCollector():
     d11_drv = ADDriver("BL38P-DI-DCAM-03:DET:")
     d11_hdf = NDFileHDF("BL38P-DI-DCAM-03:HDF5:")
     d11 = HDFStreamerDet(d11_drv, d11_hdf, d11_dir)
 
-fp = FlyingPanda(pnd)
+# PCAP data is read from the PandA's data port if its hostname is given
+panda_host = os.environ.get("PANDA_HOST")
+capture = None
+if panda_host:
+    from pcap import PandaCapture
+
+    capture = PandaCapture(panda_host, d11_dir._directory)
+fp = FlyingPanda(pnd, capture)
+
+# The sequencer's PV traffic is recorded if a trace file is given
+trace_path = os.environ.get("PANDA_TRACE")
+recorder = None
+if trace_path:
+    from pvtrace import TraceRecorder, trace_device
+
+    recorder = TraceRecorder(trace_path)
+    trace_device(pnd.seq1, recorder, "pnd-seq1")
 
-class DocHolder:
-    def __init__(self):
-        self.names = []
-        self.docs = []
-    def append(self, name, doc):
-        self.names.append(name)
-        self.docs.append(doc)
+startup.report()
 
-dh = DocHolder()
+sink = DocumentSink(d11_dir._directory / "collect_n.docs")
 
-RE(collect_n(d11, fp, 8, 1200, 0.2), dh.append)
+RE(collect_n(d11, fp, 8, 1200, 0.2, store=TableStore()), sink)
+sink.close()
+if recorder:
+    recorder.close()
 
 
 from pprint import pprint
 
-pprint(dh.names)
-pprint(dh.docs)
+docs = DocumentReader(sink.path)
+pprint(docs.names())
+for _, doc in docs:
+    pprint(doc)
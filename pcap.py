@@ -0,0 +1,310 @@
+"""Capture of PandA PCAP data to chunked HDF5 during a fly scan
+
+The PCAP frames are read from the PandA's binary data port (via the
+pandablocks client) rather than over EPICS, which keeps up with kHz trigger
+rates. Each block of frames received is appended to one resizable, chunked
+HDF5 dataset per captured field. Bluesky is told about the data with
+stream_resource/stream_datum documents referencing ranges of those datasets
+rather than with an event per frame, so the PandA must be collected into a
+named stream.
+"""
+
+import asyncio
+from pathlib import Path
+from time import perf_counter
+from uuid import uuid4
+
+import h5py
+import numpy as np
+from event_model import StreamRange, compose_stream_resource
+from pandablocks.asyncio import AsyncioClient
+from pandablocks.commands import Arm, Disarm
+from pandablocks.responses import EndData, FrameData, ReadyData, StartData
+
+
+class PcapWriter:
+    """Append-only chunked HDF5 datasets, one per captured field"""
+
+    def __init__(self, path, chunk=4096, flush_every=10_000):
+        self.path = Path(path)
+        self.chunk = chunk
+        self.flush_every = flush_every
+        self.frames = 0
+        self._file = None
+        self._datasets = {}
+        self._unflushed = 0
+
+    @property
+    def fields(self):
+        return list(self._datasets)
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    def open(self, dtype):
+        """Create the file with a dataset for each field of a frame dtype"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.frames = 0
+        self._datasets = {}
+        # Never overwrite the data of an earlier capture
+        self._file = h5py.File(self.path, "w-", libver="latest")
+        for name in dtype.names:
+            self._datasets[name] = self._file.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(self.chunk,),
+                dtype=dtype[name],
+            )
+        # Allow the data to be read while it is still being captured
+        self._file.swmr_mode = True
+
+    def append(self, data):
+        """Append a structured array of frames to every dataset"""
+        start = self.frames
+        self.frames += len(data)
+        for name, dataset in self._datasets.items():
+            dataset.resize((self.frames,))
+            dataset[start:] = data[name]
+        self._unflushed += len(data)
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for dataset in self._datasets.values():
+            dataset.flush()
+        self._unflushed = 0
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+class PandaCapture:
+    """Stream PCAP frames from a PandA into a PcapWriter while armed
+
+    Each capture is written to a new file in directory, named after the name
+    given to arm or a random uuid. Throughput is recorded as frames/s over the
+    capture along with the largest number of frames received in a single
+    block and time spent writing them.
+    """
+
+    def __init__(self, host, directory, chunk=4096, flush_every=10_000):
+        self.host = host
+        self.directory = Path(directory)
+        self.writer = PcapWriter(self.directory / "panda.h5", chunk, flush_every)
+        self.started = asyncio.Event()
+        self.fields = []
+        """Names of the captured fields, known once arm returns"""
+        self.end = None
+        self.missed = 0
+        self.elapsed = 0.0
+        self.write_time = 0.0
+        self.largest_block = 0
+        self._client = None
+        self._task = None
+        self._subscribers = []
+
+    def subscribe_value(self, function):
+        """Call function with the number of frames written after each block"""
+        self._subscribers.append(function)
+        function(self.writer.frames)
+
+    def clear_sub(self, function):
+        self._subscribers.remove(function)
+
+    async def _capture(self):
+        start = None
+        try:
+            async with AsyncioClient(self.host) as client:
+                self._client = client
+                async for data in client.data(scaled=True, flush_period=0.1):
+                    if isinstance(data, ReadyData):
+                        await client.send(Arm())
+                    elif isinstance(data, StartData):
+                        start = perf_counter()
+                        # Named as the fields of each FrameData's dtype
+                        self.fields = [f"{f.name}.{f.capture}" for f in data.fields]
+                        self.missed = data.missed
+                        self.started.set()
+                    elif isinstance(data, FrameData):
+                        before = perf_counter()
+                        frames = data.data
+                        if not self.writer.is_open:
+                            self.writer.open(frames.dtype)
+                        self.writer.append(frames)
+                        self.write_time += perf_counter() - before
+                        self.largest_block = max(self.largest_block, len(frames))
+                        for function in list(self._subscribers):
+                            function(self.writer.frames)
+                    elif isinstance(data, EndData):
+                        self.end = data
+                        return
+        finally:
+            self._client = None
+            if start is not None:
+                self.elapsed = perf_counter() - start
+            self.writer.close()
+
+    async def arm(self, name=None, timeout=5.0):
+        """Start streaming, arm PCAP and wait for the capture to start"""
+        self.writer.path = self.directory / f"panda-{name or uuid4().hex}.h5"
+        self.started.clear()
+        self.fields = []
+        self.end = None
+        self._task = asyncio.get_running_loop().create_task(self._capture())
+        started = asyncio.ensure_future(self.started.wait())
+        done, _ = await asyncio.wait(
+            (started, self._task), timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if started not in done:
+            started.cancel()
+            await self.stop()
+            raise TimeoutError(f"PCAP capture on {self.host} did not start")
+
+    async def wait(self, timeout=10.0):
+        """Wait for the PandA to end the capture"""
+        await asyncio.wait_for(asyncio.shield(self._task), timeout)
+
+    async def disarm(self, timeout=10.0):
+        """Disarm PCAP and wait for the remaining frames to be written"""
+        if self._client is not None:
+            await self._client.send(Disarm())
+        await self.wait(timeout)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        frames = self.writer.frames
+        return {
+            "frames": frames,
+            "missed": self.missed,
+            "elapsed": self.elapsed,
+            "frames_per_second": frames / self.elapsed if self.elapsed else None,
+            "write_time": self.write_time,
+            "largest_block": self.largest_block,
+            "end_reason": getattr(getattr(self.end, "reason", None), "name", None),
+        }
+
+
+class StreamDocs:
+    """Build stream_resource and stream_datum documents for PcapWriter data
+
+    fields are the captured fields (PandaCapture.fields once armed), so the
+    data keys can be described before any frames are written. One
+    stream_resource is emitted per field the first time documents are
+    requested, then each call covers the frames written since the last one.
+    Sequence numbers are left for the RunEngine to fill in.
+    """
+
+    def __init__(self, writer, name, fields, mimetype="application/x-hdf5"):
+        self.writer = writer
+        self.name = name
+        self.fields = list(fields)
+        self.mimetype = mimetype
+        self._resources = {}
+        self._emitted = 0
+
+    def data_key(self, field):
+        # Data keys may not contain dots
+        return f"{self.name}-{field.replace('.', '-')}"
+
+    def describe(self, source):
+        return {
+            self.data_key(field): {
+                "source": f"{source}/{field}",
+                "dtype": "number",
+                "shape": [],
+                "external": "STREAM:",
+            }
+            for field in self.fields
+        }
+
+    def documents(self):
+        for field in self.fields:
+            if field not in self._resources:
+                bundle = compose_stream_resource(
+                    mimetype=self.mimetype,
+                    uri=f"file://localhost{self.writer.path.absolute()}",
+                    data_key=self.data_key(field),
+                    parameters={"dataset": field, "chunk_shape": [self.writer.chunk]},
+                )
+                self._resources[field] = bundle
+                yield "stream_resource", bundle.stream_resource_doc
+        frames = self.writer.frames
+        if frames > self._emitted:
+            indices = StreamRange(start=self._emitted, stop=frames)
+            for bundle in self._resources.values():
+                yield "stream_datum", bundle.compose_stream_datum(indices=indices)
+            self._emitted = frames
+
+
+def test_pcap_writer_and_docs(tmp_path):
+    from bluesky import RunEngine
+    from bluesky import plan_stubs as bps
+    from bluesky import preprocessors as bpp
+
+    dtype = np.dtype(
+        [("COUNTER1.OUT.Value", np.float64), ("PCAP.TS_TRIG.Value", np.float64)]
+    )
+    writer = PcapWriter(tmp_path / "pcap.h5", chunk=8, flush_every=8)
+    docs = StreamDocs(writer, "panda", dtype.names)
+
+    class Flyer:
+        name = "panda"
+
+        def describe_collect(self):
+            return {self.name: docs.describe("panda://sim")}
+
+        def collect_asset_docs(self):
+            yield from docs.documents()
+
+    flyer = Flyer()
+    block = np.zeros(10, dtype)
+    block["COUNTER1.OUT.Value"] = np.arange(10)
+
+    @bpp.run_decorator()
+    def plan():
+        # Described and collected before the first frame opens the file
+        yield from bps.collect(flyer, name="panda")
+        writer.open(dtype)
+        writer.append(block)
+        writer.append(block[:3])
+        yield from bps.collect(flyer, name="panda")
+        writer.append(block[:2])
+        yield from bps.collect(flyer, name="panda")
+
+    emitted = []
+    RunEngine()(plan(), lambda name, doc: emitted.append((name, doc)))
+    writer.close()
+    (descriptor,) = [doc for name, doc in emitted if name == "descriptor"]
+    assert descriptor["name"] == "panda"
+    assert set(descriptor["data_keys"]) == {
+        "panda-COUNTER1-OUT-Value",
+        "panda-PCAP-TS_TRIG-Value",
+    }
+    resources = [doc for name, doc in emitted if name == "stream_resource"]
+    assert [r["parameters"]["dataset"] for r in resources] == list(dtype.names)
+    datums = [doc for name, doc in emitted if name == "stream_datum"]
+    assert [(d["indices"]["start"], d["indices"]["stop"]) for d in datums] == [
+        (0, 13),
+        (0, 13),
+        (13, 15),
+        (13, 15),
+    ]
+    assert all(d["descriptor"] == descriptor["uid"] for d in datums)
+    assert datums[-1]["seq_nums"]["stop"] - datums[-1]["seq_nums"]["start"] == 2
+    with h5py.File(tmp_path / "pcap.h5", "r") as f:
+        values = f["COUNTER1.OUT.Value"][:].tolist()
+        assert values == list(range(10)) + [0, 1, 2, 0, 1]
+        assert f["COUNTER1.OUT.Value"].chunks == (8,)
@@ -0,0 +1,156 @@
+"""Beam positions from blocks of raw Tetramm currents
+
+The IOC only publishes positions averaged over the averaging time. When the
+four raw currents are streamed, PositionCalculator works out X, Y and the sum
+for every reading with the same arithmetic as the quadEM driver:
+
+    Square:  X = ((I2 + I3) - (I1 + I4)) / sum,  Y = ((I1 + I2) - (I3 + I4)) / sum
+    Diamond: X = (I3 - I1) / (I1 + I3),          Y = (I2 - I4) / (I2 + I4)
+
+Currents are calibrated (gain then offset) and, as the driver does, averaged
+over values_per_reading samples before the positions are calculated. All the
+work happens in buffers allocated when the calculator is created, so feeding
+it blocks of samples allocates nothing per sample.
+
+    calc = PositionCalculator(TetrammGeometry.Diamond, values_per_reading=10)
+    out = np.empty((3, calc.readings(len(samples[0]))))
+    count = calc.feed(samples, out)  # out[0], out[1], out[2] are x, y, sum
+"""
+
+import numpy as np
+
+from tetramm import TetrammGeometry
+
+X, Y, SUM = range(3)
+"""Rows of the output of PositionCalculator"""
+
+
+class PositionCalculator:
+    def __init__(
+        self,
+        geometry=TetrammGeometry.Square,
+        gains=1.0,
+        offsets=0.0,
+        scale=(1.0, 1.0),
+        position_offsets=(0.0, 0.0),
+        values_per_reading=1,
+        capacity=65536,
+    ):
+        self.geometry = TetrammGeometry(geometry)
+        self.values_per_reading = values_per_reading
+        # Work in whole readings so a full buffer never splits one
+        self.capacity = max(capacity // values_per_reading, 1) * values_per_reading
+        self.gains = np.broadcast_to(np.asarray(gains, np.float64), (4,))[:, None]
+        self.offsets = np.broadcast_to(np.asarray(offsets, np.float64), (4,))[:, None]
+        self.scale = tuple(scale)
+        self.position_offsets = tuple(position_offsets)
+        self._work = np.empty((4, self.capacity))
+        self._mean = np.empty((4, self.capacity // values_per_reading))
+        self._sum = np.empty(self.capacity // values_per_reading)
+        self._held = 0
+
+    def readings(self, samples):
+        """Most readings that feeding samples more samples can produce"""
+        return (self._held + samples) // self.values_per_reading
+
+    def reset(self):
+        """Discard samples held back from an incomplete reading"""
+        self._held = 0
+
+    def feed(self, currents, out):
+        """Write x, y and sum of each reading in currents to out
+
+        currents is a (4, n) array of raw samples and out a (3, m) array with
+        room for readings(n) readings. Samples left over that do not make a
+        whole reading are kept and used by the next call. Returns the number
+        of readings written.
+        """
+        vpr = self.values_per_reading
+        samples = currents.shape[1]
+        written = start = 0
+        while start < samples:
+            take = min(self.capacity - self._held, samples - start)
+            work = self._work[:, self._held : self._held + take]
+            np.multiply(currents[:, start : start + take], self.gains, out=work)
+            np.subtract(work, self.offsets, out=work)
+            filled = self._held + take
+            whole = filled - filled % vpr
+            written += self._positions(whole, out[:, written:])
+            self._held = filled - whole
+            self._work[:, : self._held] = self._work[:, whole:filled]
+            start += take
+        return written
+
+    def _positions(self, samples, out):
+        vpr = self.values_per_reading
+        count = samples // vpr
+        if vpr == 1:
+            c = self._work[:, :samples]
+        else:
+            c = self._mean[:, :count]
+            blocks = self._work[:, :samples].reshape(4, count, vpr)
+            np.sum(blocks, axis=2, out=c)
+            np.multiply(c, 1 / vpr, out=c)
+        x, y, total = out[X, :count], out[Y, :count], out[SUM, :count]
+        np.add(c[0], c[1], out=total)
+        np.add(total, c[2], out=total)
+        np.add(total, c[3], out=total)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.geometry == TetrammGeometry.Square:
+                np.add(c[1], c[2], out=x)
+                np.subtract(x, c[0], out=x)
+                np.subtract(x, c[3], out=x)
+                np.divide(x, total, out=x)
+                np.add(c[0], c[1], out=y)
+                np.subtract(y, c[2], out=y)
+                np.subtract(y, c[3], out=y)
+                np.divide(y, total, out=y)
+            else:
+                sums = self._sum[:count]
+                np.add(c[0], c[2], out=sums)
+                np.subtract(c[2], c[0], out=x)
+                np.divide(x, sums, out=x)
+                np.add(c[1], c[3], out=sums)
+                np.subtract(c[1], c[3], out=y)
+                np.divide(y, sums, out=y)
+        for row, scale, offset in zip((x, y), self.scale, self.position_offsets):
+            if scale != 1.0:
+                np.multiply(row, scale, out=row)
+            if offset:
+                np.subtract(row, offset, out=row)
+        return count
+
+
+def positions(currents, geometry=TetrammGeometry.Square, **calibration):
+    """x, y and sum arrays for every reading of (4, n) currents"""
+    calc = PositionCalculator(geometry, **calibration)
+    out = np.empty((3, calc.readings(np.shape(currents)[1])))
+    calc.feed(np.asarray(currents, np.float64), out)
+    return out[X], out[Y], out[SUM]
+
+
+def test_square_positions():
+    currents = np.array([[1.0, 2.0], [1.0, 2.0], [1.0, 0.0], [1.0, 0.0]])
+    x, y, total = positions(currents, TetrammGeometry.Square)
+    assert total.tolist() == [4.0, 4.0]
+    assert x.tolist() == [0.0, 0.0]
+    assert y.tolist() == [0.0, 1.0]
+
+
+def test_diamond_positions_averaged():
+    rng = np.random.default_rng(0)
+    currents = rng.uniform(1, 2, (4, 103))
+    gains = [1.0, 2.0, 1.0, 0.5]
+    calc = PositionCalculator(
+        TetrammGeometry.Diamond, gains=gains, values_per_reading=5, capacity=12
+    )
+    out = np.zeros((3, 20))
+    # Blocks that split readings give the same result as one big block
+    count = calc.feed(currents[:, :7], out)
+    count += calc.feed(currents[:, 7:], out[:, count:])
+    assert count == 20
+    mean = (currents[:, :100] * np.array(gains)[:, None]).reshape(4, 20, 5).mean(2)
+    np.testing.assert_allclose(out[X], (mean[2] - mean[0]) / (mean[0] + mean[2]))
+    np.testing.assert_allclose(out[Y], (mean[1] - mean[3]) / (mean[1] + mean[3]))
+    np.testing.assert_allclose(out[SUM], mean.sum(0))
+    assert calc.readings(2) == 1
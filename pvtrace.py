@@ -0,0 +1,279 @@
+"""Record PV traffic to a binary trace and replay monitors into sim signals
+
+trace_device wraps the backend of every signal of a device (eg pnd.seq1, a
+Tetramm or a Linkam) so each put, get and monitor update is written to a
+TraceRecorder along with the nanoseconds since recording started. Puts are
+recorded when they are sent and again when they complete, so the trace shows
+how long each write took as well as what was written.
+
+    recorder = TraceRecorder("display.trace")
+    trace_device(pnd.seq1, recorder, "seq1")
+    ...
+    recorder.close()
+
+read_trace gives the records back and replay feeds the recorded monitor
+updates into sim signals at the original pace (or faster, or as fast as
+possible), so control loops can be profiled offline against real timings.
+
+Sim signals replace their backend when connected, so devices connected with
+sim=True must be traced after connecting.
+"""
+
+import asyncio
+import struct
+from enum import Enum
+from time import perf_counter_ns, time
+from typing import NamedTuple
+
+import msgpack
+import numpy as np
+from ophyd.v2.core import Signal, get_device_children, set_sim_value
+
+MAGIC = b"PVTRACE1"
+_HEADER = struct.Struct("<8sd")
+_RECORD = struct.Struct("<QBHI")
+_NDARRAY = 1
+
+PUT, PUT_DONE, GET, MONITOR, NAME = range(5)
+"""Kinds of trace record"""
+
+KINDS = ("put", "put_done", "get", "monitor", "name")
+
+
+class TraceRecord(NamedTuple):
+    time: float
+    """Seconds since recording started"""
+    kind: int
+    name: str
+    value: object
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        data = msgpack.packb([obj.dtype.str, obj.shape, obj.tobytes()])
+        return msgpack.ExtType(_NDARRAY, data)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f"Can't serialize {type(obj).__name__}")
+
+
+def _ext_hook(code, data):
+    if code == _NDARRAY:
+        dtype, shape, raw = msgpack.unpackb(data)
+        return np.frombuffer(raw, dtype).reshape(shape)
+    return msgpack.ExtType(code, data)
+
+
+class TraceRecorder:
+    """Writes trace records for signals traced with trace_device to path
+
+    Each record is a fixed size header (time, kind, signal id, length)
+    followed by the msgpack encoded value. Signal names are written once, the
+    first time each signal is seen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.start_time = time()
+        self._start = perf_counter_ns()
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(MAGIC, self.start_time))
+        self._packer = msgpack.Packer(default=_default)
+        self._ids = {}
+        self.records = 0
+
+    def _id(self, name):
+        if name not in self._ids:
+            self._ids[name] = len(self._ids)
+            self._write(NAME, self._ids[name], name)
+        return self._ids[name]
+
+    def _write(self, kind, signal_id, value):
+        payload = self._packer.pack(value)
+        now = perf_counter_ns() - self._start
+        self._file.write(_RECORD.pack(now, kind, signal_id, len(payload)))
+        self._file.write(payload)
+        self.records += 1
+
+    def record(self, kind, name, value=None):
+        if not self._file.closed:
+            self._write(kind, self._id(name), value)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TracingBackend:
+    """Signal backend recording the traffic through the backend it wraps"""
+
+    def __init__(self, backend, recorder, name):
+        self._backend = backend
+        self._recorder = recorder
+        self._name = name
+
+    def __getattr__(self, attr):
+        # datatype, read_pv and anything else backend specific
+        return getattr(self._backend, attr)
+
+    @property
+    def source(self):
+        return self._backend.source
+
+    async def connect(self, *args, **kwargs):
+        await self._backend.connect(*args, **kwargs)
+
+    async def put(self, value, *args, **kwargs):
+        self._recorder.record(PUT, self._name, value)
+        await self._backend.put(value, *args, **kwargs)
+        self._recorder.record(PUT_DONE, self._name)
+
+    async def get_descriptor(self):
+        return await self._backend.get_descriptor()
+
+    async def get_reading(self):
+        reading = await self._backend.get_reading()
+        self._recorder.record(GET, self._name, reading["value"])
+        return reading
+
+    async def get_value(self):
+        value = await self._backend.get_value()
+        self._recorder.record(GET, self._name, value)
+        return value
+
+    def set_callback(self, callback):
+        if callback is None:
+            self._backend.set_callback(None)
+            return
+
+        def traced(reading, value):
+            self._recorder.record(MONITOR, self._name, value)
+            callback(reading, value)
+
+        self._backend.set_callback(traced)
+
+
+def _signals(device, name):
+    if isinstance(device, Signal):
+        yield name, device
+        return
+    for child_name, child in get_device_children(device):
+        yield from _signals(child, f"{name}-{child_name}")
+
+
+def trace_device(device, recorder, name=None):
+    """Record the traffic of every signal of device, returns their names"""
+    traced = []
+    for signal_name, signal in _signals(device, name or device.name or "device"):
+        if not isinstance(signal._backend, TracingBackend):
+            signal._backend = TracingBackend(signal._backend, recorder, signal_name)
+        traced.append(signal_name)
+    return traced
+
+
+def read_trace(path):
+    """Records of a trace written by TraceRecorder, in order"""
+    names = {}
+    with open(path, "rb") as f:
+        magic, _ = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a PV trace")
+        while header := f.read(_RECORD.size):
+            if len(header) < _RECORD.size:
+                break
+            ns, kind, signal_id, length = _RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                # The recording was cut off part way through a record
+                break
+            value = msgpack.unpackb(payload, ext_hook=_ext_hook)
+            if kind == NAME:
+                names[signal_id] = value
+                continue
+            yield TraceRecord(ns / 1e9, kind, names[signal_id], value)
+
+
+def _sim_value(signal, value):
+    datatype = getattr(signal._backend, "datatype", None)
+    if isinstance(datatype, type) and issubclass(datatype, Enum):
+        return datatype(value)
+    return value
+
+
+async def replay(records, signals, speed=1.0):
+    """Set sim signals to their recorded monitor values at the recorded times
+
+    signals maps traced names to sim signals, records for other names are
+    ignored. speed scales the pace of the replay, None replays as fast as
+    possible. Returns the number of updates replayed.
+    """
+    loop = asyncio.get_running_loop()
+    start = None
+    count = 0
+    for record in records:
+        if record.kind != MONITOR or record.name not in signals:
+            continue
+        signal = signals[record.name]
+        if start is None:
+            start = loop.time() - (record.time / speed if speed else 0)
+        if speed:
+            delay = start + record.time / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        set_sim_value(signal, _sim_value(signal, record.value))
+        count += 1
+    return count
+
+
+def test_trace_and_replay(tmp_path):
+    from linkam import Linkam
+
+    path = tmp_path / "linkam.trace"
+
+    async def run():
+        linkam = Linkam("SIM-LINKAM")
+        await linkam.connect(sim=True)
+        with TraceRecorder(path) as recorder:
+            names = trace_device(linkam, recorder, "linkam")
+            assert "linkam-set_point" in names
+            linkam.set_point.subscribe_value(lambda value: None)
+            await linkam.set_point.set(20.0)
+            await linkam.set_point.set(30.0)
+            await linkam.ramp_rate.get_value()
+        records = list(read_trace(path))
+        assert [KINDS[r.kind] for r in records[:1]] == ["monitor"]
+        puts = [r.value for r in records if r.kind == PUT]
+        assert puts == [20.0, 30.0]
+        assert sum(r.kind == PUT_DONE for r in records) == 2
+        assert records[-1].kind == GET and records[-1].name == "linkam-ramp_rate"
+        assert [r.time for r in records] == sorted(r.time for r in records)
+
+        target = Linkam("SIM-LINKAM")
+        await target.connect(sim=True)
+        seen = []
+        target.set_point.subscribe_value(seen.append)
+        count = await replay(records, {"linkam-set_point": target.set_point}, None)
+        assert count == 3
+        assert seen[-2:] == [20.0, 30.0]
+
+    asyncio.run(run())
+
+
+def test_trace_arrays(tmp_path):
+    path = tmp_path / "arrays.trace"
+    with TraceRecorder(path) as recorder:
+        recorder.record(MONITOR, "tetramm-series", np.arange(4.0))
+        recorder.record(PUT, "seq1-table", {"REPEATS": np.ones(2, np.uint16)})
+    monitor, put = read_trace(path)
+    assert monitor.value.tolist() == [0.0, 1.0, 2.0, 3.0]
+    assert put.value["REPEATS"].dtype == np.uint16
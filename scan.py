@@ -0,0 +1,114 @@
+"""Compile vectorised scan descriptions into sequencer tables
+
+A scan is described by one value per point for any of the frame columns
+(time1, outa1, time2, ...), given as arrays or scalars that broadcast to the
+number of points. Points are compiled a block at a time: each block becomes
+one row per point, consecutive identical rows are folded into repeats (see
+tables.fold_repeats) and the rows are cut into tables of at most length rows
+for double buffered upload. Only one block of points and one table of rows
+are held at once, so scans of millions of points compile in bounded memory.
+Scans that are repeated can be compiled once and saved with cached_scan.
+
+    chunks = compile_scan(point_blocks(count, time1=exposures, time2=10, outa1=1))
+"""
+
+import numpy as np
+
+import tables
+
+
+def point_blocks(count, block=65536, **columns):
+    """Yield dicts of column slices for block points at a time
+
+    Columns are broadcast to count points without copying, so scalars and
+    short repeating patterns cost nothing until their block is compiled. With
+    no columns every point is a default frame.
+    """
+    columns = {
+        name: np.broadcast_to(value, (count,))
+        for name, value in (columns or {"repeats": 1}).items()
+    }
+    for start in range(0, count, block):
+        yield {name: value[start : start + block] for name, value in columns.items()}
+
+
+def compile_rows(blocks):
+    """Yield folded FRAME_DTYPE rows for each block of points
+
+    The last row of each block is held back so that it can be merged with the
+    first row of the next one.
+    """
+    held = tables.FrameBuffer(1)
+    for columns in blocks:
+        rows = tables.FrameBuffer(len(next(iter(columns.values()), ())) + 1)
+        rows.extend(held)
+        rows.extend(**columns)
+        folded, _ = tables.fold_repeats(rows)
+        held = folded[-1:]
+        if len(folded) > 1:
+            yield folded.data[:-1]
+    if len(held):
+        yield held.data
+
+
+def compile_scan(blocks, length=1024):
+    """Yield FrameBuffers of up to length rows covering every point in blocks"""
+    pending = tables.FrameBuffer(length)
+    for rows in compile_rows(blocks):
+        start = 0
+        while start < len(rows):
+            take = min(length - len(pending), len(rows) - start)
+            pending.extend(rows[start : start + take])
+            start += take
+            if len(pending) == length:
+                yield pending
+                pending = tables.FrameBuffer(length)
+    if len(pending):
+        yield pending
+
+
+def scan_tables(blocks, length=1024):
+    """SeqTables for compile_scan(blocks, length)"""
+    return (chunk.to_table() for chunk in compile_scan(blocks, length))
+
+
+def cached_scan(store, count, length=1024, **columns):
+    """List of compile_scan chunks for these points, through a TableStore
+
+    The compiled chunks are keyed by the point columns so repeating a scan,
+    even from a new process, loads its tables rather than compiling them.
+    Unlike compile_scan every chunk is held at once, which suits the folded
+    scans that are repeated, not one-off scans of millions of distinct points.
+    """
+
+    def build(count, length, **columns):
+        return list(compile_scan(point_blocks(count, **columns), length))
+
+    return store.cached("scan", build, count, length, **columns)
+
+
+def test_compile_scan():
+    exposures = np.repeat([100, 200, 100], [5, 3, 70_000])
+    blocks = point_blocks(len(exposures), block=1000, time1=exposures, time2=10)
+    chunks = list(compile_scan(blocks, length=2))
+    rows = [row for chunk in chunks for row in chunk]
+    assert [len(chunk) for chunk in chunks] == [2, 2]
+    assert rows == [
+        tables.frame(repeats=5, time1=100, time2=10),
+        tables.frame(repeats=3, time1=200, time2=10),
+        tables.frame(repeats=tables.MAX_REPEATS, time1=100, time2=10),
+        tables.frame(repeats=70_000 - tables.MAX_REPEATS, time1=100, time2=10),
+    ]
+
+
+def test_compile_scan_interleaved():
+    gates = np.tile([[1, 0], [0, 1]], (3, 1))
+    blocks = point_blocks(6, block=4, time1=50, outa1=gates[:, 0], outb1=gates[:, 1])
+    rows = [row for chunk in compile_scan(blocks) for row in chunk]
+    assert len(rows) == 6
+    assert [(r.outa1, r.outb1) for r in rows] == [(1, 0), (0, 1)] * 3
+
+
+def test_compile_scan_defaults():
+    rows = [row for chunk in compile_scan(point_blocks(5, block=2)) for row in chunk]
+    assert rows == [tables.frame(repeats=5)]
@@ -0,0 +1,420 @@
+"""Simulated PandA sequencer for running table producers without hardware
+
+SimPandA has a seq1 block with the same signal names as PandA.seq1 and is
+connected in sim mode. A SimSeqEngine attached to it executes the tables
+written to seq1.table row by row against a simulated clock and a synthetic
+POSA encoder, updating active and can_write_next as the hardware would.
+
+Double buffering is modelled as: a table written while the sequencer is
+running is held as the next table and can_write_next drops to 0 until it is
+swapped in. The swap happens when the current table completes or, if the
+current line repeats forever (repeats=0), at the end of the current repeat.
+If a table completes with no next table the sequencer goes idle. When tables
+were being streamed this is counted as an underrun if another table arrives
+afterwards, so the deliberate end of a stream is not counted.
+"""
+
+import asyncio
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+from ophyd.v2.core import (
+    Device,
+    SignalR,
+    SignalRW,
+    SimSignalBackend,
+    set_sim_value,
+)
+from ophyd_epics_devices.panda import SeqTable
+
+import tables
+
+_WAIT, _PHASE1, _PHASE2 = range(3)
+
+_IMMEDIATE = tables.trigger_code("Immediate")
+
+
+class SawtoothEncoder:
+    """Position falling at speed counts/s from high to low before jumping back
+
+    Approximates the encoder on the spinning light demo, where the display
+    tables wait for POSA>=POSITION and then follow decreasing positions.
+    """
+
+    def __init__(self, speed=6_000.0, high=1_000, low=0):
+        self.speed = speed
+        self.high = high
+        self.low = low
+
+    def __call__(self, t):
+        return self.high - (self.speed * t) % (self.high - self.low)
+
+    def next_time(self, t, position, rising):
+        """Earliest time >= t at which POSA >= position (rising) or <= position"""
+        current = self(t)
+        if rising:
+            if current >= position:
+                return t
+            if position > self.high:
+                return float("inf")
+            return t + (current - self.low) / self.speed
+        if current <= position:
+            return t
+        if position < self.low:
+            return float("inf")
+        return t + (current - position) / self.speed
+
+
+def _rows(table):
+    """Convert a SeqTable into a FRAME_DTYPE array"""
+    buf = tables.FrameBuffer(len(table.get("REPEATS", ())))
+    if len(table.get("REPEATS", ())):
+        buf.extend(**{key.lower(): value for key, value in table.items()})
+    return buf.data
+
+
+class SimSeqBlock(Device):
+    """The subset of PandA.seq1 signals modelled by SimSeqEngine"""
+
+    def __init__(self, prefix, name=""):
+        self.table = SignalRW(SimSignalBackend(SeqTable, prefix + "TABLE"))
+        self.enable = SignalRW(SimSignalBackend(str, prefix + "ENABLE"))
+        self.bita = SignalRW(SimSignalBackend(str, prefix + "BITA"))
+        self.bitb = SignalRW(SimSignalBackend(str, prefix + "BITB"))
+        self.bitc = SignalRW(SimSignalBackend(str, prefix + "BITC"))
+        self.active = SignalR(SimSignalBackend(str, prefix + "ACTIVE"))
+        self.can_write_next = SignalR(SimSignalBackend(int, prefix + "CAN_WRITE_NEXT"))
+        super().__init__(name=name)
+
+
+class SimPandA(Device):
+    """Stand in for PandA with simulated sequencers seq1 to seq<sequencers>"""
+
+    def __init__(self, prefix="SIM-PANDA", name="", sequencers=1):
+        for i in range(1, sequencers + 1):
+            setattr(self, f"seq{i}", SimSeqBlock(prefix + f":SEQ{i}:"))
+        super().__init__(name=name)
+
+
+class SimSeqEngine:
+    """Executes the tables written to a SimSeqBlock
+
+    Time in the table is in units of tick seconds. Sequencer time only moves
+    on when advance is called, either directly for deterministic tests or from
+    run/start, which follow the real clock scaled by speed.
+    """
+
+    def __init__(self, seq, encoder=None, tick=1e-6, resolution=1e-5, history=1000):
+        self.seq = seq
+        self.encoder = encoder or SawtoothEncoder()
+        self.tick = tick
+        self.resolution = resolution
+        self.now = 0.0
+        self.enabled = False
+        self.outputs = np.zeros(6, dtype=np.uint8)
+        self.tables_written = 0
+        self.swaps = 0
+        self.rows_executed = 0
+        self.underruns = 0
+        self.swap_latencies = deque(maxlen=history)
+        """Real time between can_write_next rising and the next table arriving"""
+        self._current = None
+        self._pending = None
+        self._line = 0
+        self._repeat = 0
+        self._phase = _WAIT
+        self._phase_end = 0.0
+        self._started = 0.0
+        self._streaming = False
+        self._starved = False
+        self._ready_since = None
+        self._bits = {"A": 0, "B": 0, "C": 0}
+        self._published = {}
+        self._task = None
+
+    def attach(self):
+        """Start following writes to the table, enable and bit signals"""
+        set_sim_value(self.seq.enable, "ZERO")
+        for bit in self._bits:
+            set_sim_value(getattr(self.seq, "bit" + bit.lower()), "ZERO")
+            getattr(self.seq, "bit" + bit.lower()).subscribe_value(
+                lambda value, bit=bit: self._bits.__setitem__(bit, int(value == "ONE"))
+            )
+        self.seq.table.subscribe_value(self._on_table)
+        self.seq.enable.subscribe_value(self._on_enable)
+        self._publish()
+
+    @property
+    def running(self):
+        return self.enabled and self._current is not None
+
+    def _publish(self):
+        values = {
+            self.seq.active: "1" if self.running else "0",
+            self.seq.can_write_next: int(
+                self._current is not None and self._pending is None
+            ),
+        }
+        for signal, value in values.items():
+            if self._published.get(signal) != value:
+                self._published[signal] = value
+                set_sim_value(signal, value)
+        if values[self.seq.can_write_next] and self._ready_since is None:
+            self._ready_since = perf_counter()
+
+    def _on_table(self, table):
+        rows = _rows(table)
+        if not len(rows):
+            return
+        self.tables_written += 1
+        if self._starved:
+            self.underruns += 1
+            self._starved = False
+        if self._ready_since is not None:
+            self.swap_latencies.append(perf_counter() - self._ready_since)
+            self._ready_since = None
+        if self.running:
+            self._pending = rows
+            self._streaming = True
+        else:
+            self._load(rows)
+        self._publish()
+
+    def _on_enable(self, value):
+        self.enabled = value == "ONE"
+        if self._current is not None:
+            self._load(self._current)
+        self._publish()
+
+    def _load(self, rows):
+        self._current = rows
+        self._line = 0
+        self._repeat = 0
+        self._phase = _WAIT
+
+    def _swap(self):
+        self._load(self._pending)
+        self._pending = None
+        self.swaps += 1
+
+    def _position(self, axis):
+        return self.encoder(self.now) if axis == "A" else 0
+
+    def _trigger_time(self, row):
+        """Sim time at which the trigger of row is met (inf if never)"""
+        trigger = tables.TRIGGERS[row["trigger"]]
+        if trigger == "Immediate":
+            return self.now
+        if trigger.startswith("BIT"):
+            return self.now if self._bits[trigger[3]] == int(trigger[-1]) else np.inf
+        axis = trigger[3]
+        rising = trigger[4] == ">"
+        if axis == "A" and hasattr(self.encoder, "next_time"):
+            return self.encoder.next_time(self.now, row["position"], rising)
+        position = self._position(axis)
+        if (position >= row["position"]) if rising else (position <= row["position"]):
+            return self.now
+        return self.now + self.resolution
+
+    def _finish_row(self, row):
+        self.rows_executed += 1
+        self._repeat += 1
+        self._phase = _WAIT
+        if row["repeats"] == 0:
+            if self._pending is not None:
+                self._swap()
+            elif self.now == self._started and row["trigger"] == _IMMEDIATE:
+                # An instantaneous infinite line would never let time move on
+                return False
+            return True
+        if self._repeat < row["repeats"]:
+            return True
+        self._line += 1
+        self._repeat = 0
+        if self._line < len(self._current):
+            return True
+        if self._pending is not None:
+            self._swap()
+            return True
+        self._starved = self._streaming
+        self._current = None
+        self._streaming = False
+        return False
+
+    def advance(self, duration):
+        """Move sequencer time on by duration seconds executing table rows"""
+        end = self.now + duration
+        while self.running and self.now < end:
+            row = self._current[self._line]
+            if self._phase == _WAIT:
+                fire = self._trigger_time(row)
+                if fire > end:
+                    # Step a bit at a time if bits may change while we wait
+                    self.now = end
+                    break
+                self.now = fire
+                self._started = fire
+                self._phase = _PHASE1
+                self._phase_end = fire + row["time1"] * self.tick
+                self.outputs[:] = [row[f"out{c}1"] for c in "abcdef"]
+            if self._phase == _PHASE1:
+                if self._phase_end > end:
+                    self.now = end
+                    break
+                self.now = self._phase_end
+                self._phase = _PHASE2
+                self._phase_end = self.now + row["time2"] * self.tick
+                self.outputs[:] = [row[f"out{c}2"] for c in "abcdef"]
+            if self._phase == _PHASE2:
+                if self._phase_end > end:
+                    self.now = end
+                    break
+                self.now = self._phase_end
+                if not self._finish_row(row):
+                    break
+        self.now = max(self.now, end)
+        self._publish()
+
+    async def run(self, speed=1.0, interval=1e-3):
+        """Advance in step with the real clock, speed times faster"""
+        last = perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            now = perf_counter()
+            self.advance((now - last) * speed)
+            last = now
+
+    def start(self, speed=1.0, interval=1e-3):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(
+                self.run(speed, interval)
+            )
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        latencies = np.array(self.swap_latencies)
+        return {
+            "sim_time": self.now,
+            "tables_written": self.tables_written,
+            "swaps": self.swaps,
+            "rows_executed": self.rows_executed,
+            "underruns": self.underruns,
+            "mean_swap_latency": float(latencies.mean()) if len(latencies) else None,
+            "max_swap_latency": float(latencies.max()) if len(latencies) else None,
+        }
+
+
+async def sim_panda(name="sim_panda", sequencers=1, **engine_kwargs):
+    """Create a connected SimPandA with an attached SimSeqEngine
+
+    Returns the engine for seq1, with engines for all sequencers in
+    pnd.engines.
+    """
+    pnd = SimPandA(name=name, sequencers=sequencers)
+    await pnd.connect(sim=True)
+    pnd.engines = []
+    for i in range(1, sequencers + 1):
+        engine = SimSeqEngine(getattr(pnd, f"seq{i}"), **engine_kwargs)
+        engine.attach()
+        pnd.engines.append(engine)
+    return pnd, pnd.engines[0]
+
+
+def test_sim_seq_engine_rows():
+    async def run():
+        pnd, engine = await sim_panda()
+        rows = tables.FrameBuffer()
+        rows.append(trigger="POSA>=POSITION", position=600, time1=100, outa1=1)
+        rows.append(trigger="POSA<=POSITION", position=300, time2=50, repeats=3)
+        await pnd.seq1.table.set(rows.to_table())
+        assert await pnd.seq1.can_write_next.get_value() == 1
+        await pnd.seq1.enable.set("ONE")
+        assert await pnd.seq1.active.get_value() == "1"
+        engine.advance(50e-6)
+        assert engine.outputs[0] == 1
+        engine.advance(0.1)
+        assert engine.outputs[0] == 0
+        assert engine.rows_executed == 1
+        engine.advance(1)
+        assert engine.rows_executed == 4
+        assert await pnd.seq1.active.get_value() == "0"
+        assert engine.underruns == 0
+
+    asyncio.run(run())
+
+
+def test_sim_seq_engine_display():
+    async def run():
+        pnd, engine = await sim_panda()
+        engine.start(speed=100)
+        stats = await tables.display(pnd, "hi", limit=5)
+        await engine.stop()
+        assert stats.tables == 5
+        assert engine.tables_written == 7
+        # The 5 streamed tables and the stop table, which display waits for
+        assert engine.swaps == 6
+        assert engine.underruns == 0
+
+    asyncio.run(run())
+
+
+def test_sim_seq_engine_display_multi():
+    async def run():
+        pnd, _ = await sim_panda(sequencers=2)
+        other, _ = await sim_panda("other")
+        engines = pnd.engines + other.engines
+        for engine in engines:
+            engine.start(speed=100)
+        seqs = [pnd.seq1, pnd.seq2, other.seq1]
+        stats = await tables.display_multi(seqs, ["hi", "ab", "xyz"], limit=5)
+        assert [s.tables for s in stats] == [5, 5, 5]
+        assert all(s.max_lag <= 1 for s in stats)
+        # Each sequencer also swaps in the stop table, which display waits for
+        assert [e.swaps for e in engines] == [6, 6, 6]
+
+        # One text is dealt out between the sequencers
+        written = [[] for _ in seqs]
+        for seq, tables_seen in zip(seqs, written):
+            seq.table.subscribe_value(tables_seen.append)
+        await tables.display_multi(seqs, "hello", limit=2)
+        for engine in engines:
+            await engine.stop()
+        stream = tables.CachedTableStream("hello", 30, 100)
+        expected = [next(stream) for _ in range(7)]
+        for index, tables_seen in enumerate(written):
+            # The first table to each is the one written before streaming
+            for table, want in zip(tables_seen[1:], expected[index::3]):
+                assert (table["OUTA2"] == want["OUTA2"]).all()
+
+    asyncio.run(run())
+
+
+def test_sim_seq_engine_stream_text():
+    from bluesky import RunEngine
+    from bluesky.run_engine import call_in_bluesky_event_loop
+
+    from p45demo.panda_plans import stream_text
+
+    RE = RunEngine()
+
+    async def start():
+        pnd, engine = await sim_panda()
+        engine.start(speed=100)
+        return pnd, engine
+
+    pnd, engine = call_in_bluesky_event_loop(start())
+    RE(stream_text("hello world", pnd, chunk=10, timeout=5))
+    call_in_bluesky_event_loop(engine.stop())
+    # Every table after the first, including the stop table, is swapped in
+    assert engine.tables_written > 3
+    assert engine.swaps == engine.tables_written - 1
+    assert engine.underruns == 0
@@ -0,0 +1,46 @@
+"""Record where the time goes while bringing up a session
+
+Sections of startup are timed with the timer context manager (or record for
+durations measured elsewhere) and report prints them slowest first. Imports
+of heavy modules can be timed with import_module.
+
+    with startup.timer("connect detector"):
+        ...
+    startup.report()
+"""
+
+import importlib
+from contextlib import contextmanager
+from time import perf_counter
+
+timings = []
+"""(label, seconds) in the order they were recorded"""
+
+_start = perf_counter()
+
+
+def record(label, seconds):
+    timings.append((label, seconds))
+
+
+@contextmanager
+def timer(label):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(label, perf_counter() - start)
+
+
+def import_module(name):
+    """Import a module, recording how long it took if it was not loaded"""
+    with timer(f"import {name}"):
+        return importlib.import_module(name)
+
+
+def report(file=None):
+    """Print the recorded timings, slowest first, and the total so far"""
+    total = perf_counter() - _start
+    print(f"Startup: {total:.2f}s since {__name__} was imported", file=file)
+    for label, seconds in sorted(timings, key=lambda t: -t[1]):
+        print(f"{seconds:8.3f}s  {label}", file=file)
@@ -0,0 +1,55 @@
+"""Plan stubs awaiting coroutines in the RunEngine's event loop
+
+bps.wait_for drops any error raised by what it waits for, so a failed setup
+or connect would let a plan carry on as if it had worked. await_coroutine
+re-raises it instead.
+
+    timings = yield from await_coroutine(prepare_all, setups)
+"""
+
+import asyncio
+
+from bluesky import plan_stubs as bps
+
+
+def await_coroutine(function, *args):
+    """Plan stub awaiting function(*args), returning its result or raising
+
+    The coroutine is only created when the stub runs, so it is never left
+    unawaited by a plan that stops first.
+    """
+    futures = []
+
+    def start():
+        futures.append(asyncio.ensure_future(function(*args)))
+        return futures[-1]
+
+    yield from bps.wait_for([start])
+    return futures[-1].result()
+
+
+def test_await_coroutine():
+    from bluesky import RunEngine
+
+    async def double(value):
+        await asyncio.sleep(0)
+        return value * 2
+
+    async def fail():
+        raise ValueError("failed")
+
+    results = []
+
+    def plan():
+        results.append((yield from await_coroutine(double, 21)))
+        yield from await_coroutine(fail)
+        results.append("not reached")
+
+    RE = RunEngine()
+    try:
+        RE(plan())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("the error was not raised")
+    assert results == [42]
@@ -0,0 +1,302 @@
+"""Content addressed on-disk store of compiled sequencer tables
+
+Tables are keyed by a hash of what they were generated from (a name for the
+generator along with its arguments, including the font) and saved as .npy
+files of FRAME_DTYPE rows. Loading memory maps the file so the FrameBuffer,
+and the SeqTable built from it, are views of the page cache rather than
+parsed copies. A sidecar .json holds the chunk lengths and a sha256 of the
+rows that is checked the first time each entry is loaded by a process.
+
+The store is bounded by max_bytes: files are touched when used and the least
+recently used entries are removed once the total grows past the limit. The
+sizes and order of use are read from disk once and then kept in memory, so
+storing a table does not rescan the store. A store can be shared by threads
+(eg several TablePrefetchers).
+
+    store = TableStore()
+    rows = store.cached("banner", build_banner, "hello", font="clr6x6")
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+import tables
+
+VERSION = 1
+"""Bump to invalidate stored tables when the way they are generated changes"""
+
+DEFAULT_ROOT = Path(
+    os.environ.get(
+        "PANDA_TABLE_STORE", Path.home() / ".cache" / "panda_trials" / "tables"
+    )
+)
+
+
+class IntegrityError(Exception):
+    """A stored table did not match its checksum"""
+
+
+def _encode(obj):
+    if isinstance(obj, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        return {"ndarray": digest, "dtype": str(obj.dtype), "shape": obj.shape}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return repr(obj)
+
+
+class TableStore:
+    def __init__(self, root=None, max_bytes=256 << 20, verify=True):
+        self.root = Path(root or DEFAULT_ROOT)
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self._verified = set()
+        self._lru = None
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def key(self, name, *args, **kwargs):
+        """Hash identifying the output of generator name for these arguments"""
+        source = json.dumps(
+            [VERSION, tables.FRAME_DTYPE.descr, name, args, kwargs],
+            default=_encode,
+            sort_keys=True,
+        )
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def _paths(self, key):
+        return self.root / f"{key}.npy", self.root / f"{key}.json"
+
+    def get(self, key):
+        """Stored chunks for key as FrameBuffers, or None if not stored"""
+        data_path, meta_path = self._paths(key)
+        try:
+            meta = json.loads(meta_path.read_text())
+            rows = np.load(data_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        if rows.dtype != tables.FRAME_DTYPE or len(rows) != sum(meta["lengths"]):
+            raise IntegrityError(f"Stored table {key} has the wrong shape")
+        if self.verify and key not in self._verified:
+            if hashlib.sha256(rows.tobytes()).hexdigest() != meta["sha256"]:
+                raise IntegrityError(f"Stored table {key} does not match its checksum")
+            self._verified.add(key)
+        os.utime(meta_path)
+        self._used(key)
+        offsets = np.cumsum([0] + meta["lengths"])
+        chunks = [
+            tables.FrameBuffer.from_array(rows[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        return chunks[0] if meta["single"] else chunks
+
+    def put(self, key, chunks):
+        """Store a FrameBuffer, or a list of them, under key"""
+        single = isinstance(chunks, tables.FrameBuffer)
+        if single:
+            chunks = [chunks]
+        rows = np.concatenate([chunk.data for chunk in chunks]) if chunks else (
+            np.zeros(0, tables.FRAME_DTYPE)
+        )
+        meta = {
+            "single": single,
+            "lengths": [len(chunk) for chunk in chunks],
+            "sha256": hashlib.sha256(rows.tobytes()).hexdigest(),
+        }
+        self.root.mkdir(parents=True, exist_ok=True)
+        data_path, meta_path = self._paths(key)
+        # Write to temporary files and rename so readers never see part of a
+        # table. The metadata goes last as it marks the entry as complete.
+        self._replace(data_path, lambda f: np.save(f, rows))
+        self._replace(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+        self._verified.add(key)
+        self._used(key, data_path.stat().st_size + meta_path.stat().st_size)
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def _replace(self, path, write):
+        """Replace path with a file written by write(f)
+
+        The temporary file is unique to this call, so threads and processes
+        storing the same table do not write over each other's files.
+        """
+        fd, tmp = tempfile.mkstemp(".tmp", f".{path.name}.", self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def fetch(self, key, build):
+        """Load the tables stored under key, or call build() and store them
+
+        build returns a FrameBuffer or a list of them. A corrupt entry is
+        rebuilt and replaced.
+        """
+        try:
+            stored = self.get(key)
+        except IntegrityError:
+            stored = None
+        if stored is not None:
+            self.hits += 1
+            metrics.registry.inc("table_store_hits")
+            return stored
+        self.misses += 1
+        metrics.registry.inc("table_store_misses")
+        built = build()
+        self.put(key, built)
+        return built
+
+    def cached(self, name, build, *args, **kwargs):
+        """fetch the output of build(*args, **kwargs), keyed by name and args"""
+        return self.fetch(
+            self.key(name, *args, **kwargs), lambda: build(*args, **kwargs)
+        )
+
+    def entries(self):
+        """(last used, bytes, key) of each stored table, oldest first"""
+        found = []
+        for meta_path in self.root.glob("*.json"):
+            data_path = meta_path.with_suffix(".npy")
+            try:
+                size = data_path.stat().st_size + meta_path.stat().st_size
+                found.append((meta_path.stat().st_mtime, size, meta_path.stem))
+            except FileNotFoundError:
+                continue
+        return sorted(found)
+
+    def _index(self):
+        """Size of each stored table by key, least recently used first
+
+        Only called with _lock held.
+        """
+        if self._lru is None:
+            self._lru = OrderedDict((key, size) for _, size, key in self.entries())
+            self._total = sum(self._lru.values())
+        return self._lru
+
+    def _used(self, key, size=None):
+        with self._lock:
+            lru = self._index()
+            if size is None and key not in lru:
+                # Stored by another process since the index was read
+                size = sum(path.stat().st_size for path in self._paths(key))
+            if size is not None:
+                self._total += size - lru.get(key, 0)
+                lru[key] = size
+            lru.move_to_end(key)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            self._index()
+            return self._total
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        for path in reversed(self._paths(key)):
+            path.unlink(missing_ok=True)
+        self._total -= self._index().pop(key, 0)
+        self._verified.discard(key)
+
+    def evict(self):
+        """Remove least recently used tables until within max_bytes"""
+        with self._lock:
+            lru = self._index()
+            while lru and self._total > self.max_bytes:
+                self._remove(next(iter(lru)))
+
+
+def test_table_store(tmp_path):
+    store = TableStore(tmp_path)
+    calls = []
+
+    def build(text, width):
+        calls.append(text)
+        bits = tables.bit_matrix(text)
+        return list(tables.scroll_chunks(bits, width, 20, cyclic=False))
+
+    first = store.cached("scroll", build, "ab", 12)
+    again = store.cached("scroll", build, "ab", 12)
+    assert calls == ["ab"]
+    assert again == first
+    # Loaded tables are read only views of the mapped file
+    assert not again[0].data.flags.writeable
+    table = again[0].to_table()
+    assert (table["OUTA2"] == first[0].to_table()["OUTA2"]).all()
+
+    single = store.cached("single", lambda: tables.FrameBuffer.from_frames([]))
+    assert isinstance(single, tables.FrameBuffer) and len(single) == 0
+
+    # Corrupt entries are rebuilt when a process first loads them
+    store = TableStore(tmp_path)
+    key = store.key("scroll", "ab", 12)
+    data_path = tmp_path / f"{key}.npy"
+    raw = bytearray(data_path.read_bytes())
+    raw[-1] ^= 0xFF
+    data_path.write_bytes(bytes(raw))
+    assert store.cached("scroll", build, "ab", 12) == first
+    assert calls == ["ab", "ab"]
+
+    # Least recently used entries are evicted past max_bytes
+    store.max_bytes = 3 * store.nbytes
+    for text in ("a", "b", "c", "d", "e", "f"):
+        store.cached("scroll", build, text * 2, 12)
+    assert store.nbytes <= store.max_bytes
+    assert store.nbytes == sum(size for _, size, _ in store.entries())
+    assert len(store.entries()) < 8
+    assert store.get(store.key("scroll", "ff", 12)) is not None
+
+
+def test_table_store_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    store = TableStore(tmp_path)
+
+    def build(text):
+        bits = tables.bit_matrix(text)
+        return list(tables.scroll_chunks(bits, 12, 20, cyclic=False))
+
+    # Every thread stores the same table, then different ones
+    texts = ["same"] * 8 + [str(i) for i in range(16)]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda text: store.cached("scroll", build, text), texts))
+    assert store.nbytes == sum(size for _, size, _ in store.entries())
+    assert len(store.entries()) == 17
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_table_store_streams(tmp_path):
+    import scan
+
+    store = TableStore(tmp_path)
+    first = tables.CachedTableStream("abc", 30, 100, store=store)
+    built = [next(first) for _ in range(first.period)]
+    assert store.misses == first.period and store.hits == 0
+    second = tables.CachedTableStream("abc", 30, 100, store=store)
+    for expected in built:
+        table = next(second)
+        for key, column in expected.items():
+            assert (table[key] == column).all()
+    assert store.hits == first.period
+
+    exposures = np.repeat([100, 200], [5, 3])
+    chunks = scan.cached_scan(store, 8, length=1, time1=exposures, time2=10)
+    again = scan.cached_scan(store, 8, length=1, time1=exposures, time2=10)
+    assert [len(c) for c in again] == [1, 1] and again == chunks
+    assert store.hits == first.period + 1
@@ -1,11 +1,19 @@
-from pyfiglet import Figlet
+import asyncio
 from collections import deque, namedtuple
+from contextlib import AsyncExitStack
 from itertools import cycle
+from math import gcd
+from time import perf_counter, sleep
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 from ophyd_epics_devices.panda import PandA, SeqTable, SeqTrigger
 from ophyd.v2.core import wait_for_value, observe_value
 
+import glyphs
+import metrics
+from lazy_panda import connect_blocks_of
+
 
 Frame = namedtuple(
     "Frame",
@@ -30,11 +38,233 @@ Frame = namedtuple(
     ),
 )
 
+TRIGGERS = (
+    "Immediate",
+    "BITA=0",
+    "BITA=1",
+    "BITB=0",
+    "BITB=1",
+    "BITC=0",
+    "BITC=1",
+    "POSA>=POSITION",
+    "POSA<=POSITION",
+    "POSB>=POSITION",
+    "POSB<=POSITION",
+    "POSC>=POSITION",
+    "POSC<=POSITION",
+)
+"""Sequencer trigger options, indexed by the code stored in a FrameBuffer"""
+
+FRAME_DTYPE = np.dtype(
+    [
+        ("repeats", np.uint16),
+        ("trigger", np.uint8),
+        ("position", np.int32),
+        ("time1", np.uint32),
+        ("outa1", np.uint8),
+        ("outb1", np.uint8),
+        ("outc1", np.uint8),
+        ("outd1", np.uint8),
+        ("oute1", np.uint8),
+        ("outf1", np.uint8),
+        ("time2", np.uint32),
+        ("outa2", np.uint8),
+        ("outb2", np.uint8),
+        ("outc2", np.uint8),
+        ("outd2", np.uint8),
+        ("oute2", np.uint8),
+        ("outf2", np.uint8),
+    ]
+)
+
+
+OUTPUTS2 = ("outa2", "outb2", "outc2", "outd2", "oute2", "outf2")
+"""Outputs driven during the second phase of each row, one per text line"""
+
+
+def trigger_code(trigger):
+    """Convert a trigger name (or SeqTrigger) into its FrameBuffer code"""
+    return TRIGGERS.index(getattr(trigger, "value", trigger))
+
+
+def trigger_codes(triggers):
+    """Convert an array of trigger names into FrameBuffer codes"""
+    triggers = np.asarray(triggers)
+    if triggers.dtype == object:
+        triggers = np.array([getattr(t, "value", t) for t in triggers.ravel()])
+    names, inverse = np.unique(triggers.astype(str), return_inverse=True)
+    lookup = np.array([trigger_code(t) for t in names], dtype=np.uint8)
+    return lookup[inverse].reshape(np.shape(triggers))
+
+
+class FrameBuffer:
+    """Columnar store of sequencer rows backed by a structured numpy array
+
+    Rows are kept in FRAME_DTYPE with the trigger stored as an index into
+    TRIGGERS. Slicing returns a FrameBuffer sharing the same memory and
+    to_table builds a SeqTable from views of the underlying columns.
+    """
+
+    def __init__(self, capacity=64):
+        self._data = np.zeros(max(capacity, 1), FRAME_DTYPE)
+        self._len = 0
+
+    @classmethod
+    def from_array(cls, data):
+        """Wrap an existing FRAME_DTYPE array without copying it"""
+        buf = cls.__new__(cls)
+        buf._data = np.asarray(data, FRAME_DTYPE)
+        buf._len = len(buf._data)
+        return buf
+
+    @classmethod
+    def from_frames(cls, frames):
+        buf = cls()
+        buf.extend(frames)
+        return buf
+
+    @property
+    def data(self):
+        """View of the populated rows"""
+        return self._data[: self._len]
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FrameBuffer.from_array(self.data[index])
+        return Frame(*self.data[index].item())._replace(
+            trigger=TRIGGERS[self.data[index]["trigger"]]
+        )
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, FrameBuffer):
+            return NotImplemented
+        return np.array_equal(self.data, other.data)
+
+    def column(self, name):
+        """View of a single column"""
+        return self.data[name]
+
+    def reserve(self, capacity):
+        """Ensure space for at least capacity rows"""
+        if capacity > len(self._data):
+            data = np.zeros(max(capacity, 2 * len(self._data)), FRAME_DTYPE)
+            data[: self._len] = self.data
+            self._data = data
+
+    def resize(self, length, **defaults):
+        """Grow by appending length rows of default values and return them"""
+        start = self._len
+        self.reserve(start + length)
+        self._len += length
+        rows = self._data[start : self._len]
+        rows[...] = _DEFAULT_ROW
+        for name, value in defaults.items():
+            rows[name] = trigger_codes(value) if name == "trigger" else value
+        return rows
+
+    def append(self, row=None, **kwargs):
+        """Append a Frame, or a row built from frame style keyword arguments"""
+        if row is None:
+            row = frame(**kwargs)
+        self.resize(1, **row._asdict())
+
+    def extend(self, frames=(), **columns):
+        """Append many rows
+
+        frames may be another FrameBuffer, a FRAME_DTYPE array or an iterable
+        of Frames. Alternatively, columns can be given as keyword arrays which
+        are broadcast together, unspecified columns taking frame defaults.
+        """
+        if columns:
+            length = np.broadcast(*columns.values()).size
+            self.resize(length, **columns)
+        elif isinstance(frames, FrameBuffer):
+            self.resize(len(frames))[...] = frames.data
+        elif isinstance(frames, np.ndarray) and frames.dtype == FRAME_DTYPE:
+            self.resize(len(frames))[...] = frames
+        else:
+            frames = list(frames)
+            if frames:
+                self.extend(**dict(zip(Frame._fields, zip(*frames))))
+
+    def to_table(self):
+        """Convert to a SeqTable sharing memory with this buffer"""
+        data = self.data
+        table = SeqTable()
+        table["REPEATS"] = data["repeats"]
+        table["POSITION"] = data["position"]
+        table["TRIGGER"] = _TRIGGER_NAMES[data["trigger"]]
+        table["TIME1"] = data["time1"]
+        table["OUTA1"] = data["outa1"]
+        table["OUTB1"] = data["outb1"]
+        table["OUTC1"] = data["outc1"]
+        table["OUTD1"] = data["outd1"]
+        table["OUTE1"] = data["oute1"]
+        table["OUTF1"] = data["outf1"]
+        table["TIME2"] = data["time2"]
+        table["OUTA2"] = data["outa2"]
+        table["OUTB2"] = data["outb2"]
+        table["OUTC2"] = data["outc2"]
+        table["OUTD2"] = data["outd2"]
+        table["OUTE2"] = data["oute2"]
+        table["OUTF2"] = data["outf2"]
+        return table
+
+
+MAX_REPEATS = np.iinfo(np.uint16).max
+"""Largest repeat count a single sequencer row can hold"""
+
+
+def fold_repeats(frames):
+    """Merge runs of identical rows into single rows with more repeats
+
+    Only rows with an Immediate trigger are merged as rows waiting on a bit or
+    position could behave differently if they became repeats of another row.
+    Rows with 0 (infinite) repeats are never merged and merged rows are split
+    again where they would exceed MAX_REPEATS.
+
+    Returns the folded FrameBuffer and the ratio of input to output rows.
+    """
+    if not isinstance(frames, FrameBuffer):
+        frames = FrameBuffer.from_frames(frames)
+    data = frames.data
+    if len(data) < 2:
+        return FrameBuffer.from_array(data.copy()), 1.0
+    key = data.copy()
+    key["repeats"] = 0
+    foldable = (data["trigger"] == trigger_code("Immediate")) & (data["repeats"] > 0)
+    join = (key[1:] == key[:-1]) & foldable[1:] & foldable[:-1]
+    starts = np.flatnonzero(np.concatenate(([True], ~join)))
+    totals = np.add.reduceat(data["repeats"].astype(np.int64), starts)
+    rows = np.maximum(1, -(-totals // MAX_REPEATS))
+    folded = np.repeat(data[starts], rows)
+    folded["repeats"] = MAX_REPEATS
+    folded["repeats"][np.cumsum(rows) - 1] = totals - MAX_REPEATS * (rows - 1)
+    return FrameBuffer.from_array(folded), len(data) / len(folded)
+
+
+FONT = "clr6x6"
+"""Font used to render text for the display"""
+
 
 def frames(text):
     """Convert the given text into 6x6 block format"""
-    lines = Figlet(font="clr6x6", width=10 * len(text)).renderText(text).splitlines()
-    return zip(*[[0 if c == " " else 1 for c in line] for line in lines][::-1])
+    return map(tuple, bit_matrix(text).tolist())
+
+
+def bit_matrix(text):
+    """Render text as a (columns, lines) array of bits, bottom line first"""
+    lines = glyphs.render(text, FONT, 10 * len(text))
+    columns = min((len(line) for line in lines), default=0)
+    bits = np.array([line[:columns] for line in lines[::-1]], dtype=np.uint8)
+    return bits.reshape(len(lines), columns).T
 
 
 def table_frames(frames, width, posn=600, step=6):
@@ -87,6 +317,12 @@ def frame(
     )
 
 
+_DEFAULT_ROW = np.array(
+    frame()._replace(trigger=trigger_code("Immediate")), dtype=FRAME_DTYPE
+)
+_TRIGGER_NAMES = np.array(TRIGGERS)
+
+
 def as_table_frame(buffer, posn=600, step=6):
     """Convert a set of frame data into frames with positions and triggers"""
     yield frame(trigger="POSA>=POSITION", position=posn)
@@ -107,6 +343,228 @@ def as_table_frame(buffer, posn=600, step=6):
     yield frame(trigger="POSA<=POSITION", position=max(0, posn))
 
 
+def window_positions(width, posn=600, step=6):
+    """Positions of the columns shown in a window and the trailing position
+
+    Matches the rows generated by as_table_frame for a full window.
+    """
+    positions = []
+    for _ in range(width):
+        positions.append(posn)
+        posn -= step
+        if posn <= 0:
+            break
+    return positions, max(0, posn)
+
+
+def window_template(width, posn=600, step=6):
+    """FrameBuffer of the rows for one window with all outputs cleared"""
+    positions, last = window_positions(width, posn, step)
+    template = FrameBuffer(len(positions) + 2)
+    template.append(trigger="POSA>=POSITION", position=posn)
+    template.extend(trigger="POSA<=POSITION", position=positions + [last])
+    return template
+
+
+def scroll_chunks(bits, width, length, posn=600, step=6, cyclic=True):
+    """Vectorised equivalent of table_chunks(table_frames(...)) for a bit matrix
+
+    bits is a (columns, lines) array as returned by bit_matrix. Windows are
+    built in batches with sliding_window_view and yielded as FrameBuffers of
+    length rows plus the terminating zero-repeat row. If cyclic, the columns
+    are repeated indefinitely as with cycle(frames(text)).
+    """
+    bits = np.asarray(bits, dtype=np.uint8)[:, :6]
+    columns = len(bits)
+    template = window_template(width, posn, step).data
+    shown = len(template) - 2
+    windows = None if cyclic else max(0, columns - width)
+    if columns == 0:
+        return
+    batch = max(64, -(-length // len(template)))
+    pending = FrameBuffer(length + batch * len(template))
+    start = 0
+    while windows is None or start < windows:
+        count = batch if windows is None else min(batch, windows - start)
+        index = np.arange(start, start + count + shown - 1)
+        if cyclic:
+            index %= columns
+        view = sliding_window_view(bits[index], shown, axis=0)
+        rows = np.tile(template, count).reshape(count, len(template))
+        for i, name in enumerate(OUTPUTS2):
+            rows[name][:, 1:-1] = view[:, i, :]
+        pending.extend(rows.reshape(-1))
+        start += count
+        full = len(pending) // length * length
+        for offset in range(0, full, length):
+            chunk = FrameBuffer(length + 1)
+            chunk.extend(pending.data[offset : offset + length])
+            chunk.append(repeats=0)
+            yield chunk
+        remainder = pending.data[full:].copy()
+        pending = FrameBuffer(length + batch * len(template))
+        pending.extend(remainder)
+
+
+def render_columns(text, segment=256):
+    """Yield bit_matrix blocks for text rendered segment characters at a time
+
+    Only one segment is rendered at a time so arbitrarily long text can be
+    streamed in constant memory. Each segment is laid out on its own, so the
+    spacing at segment boundaries can differ from rendering the whole text
+    in fonts that kern.
+    """
+    for start in range(0, len(text), segment):
+        yield bit_matrix(text[start : start + segment])
+
+
+def stream_chunks(blocks, width, length, posn=600, step=6):
+    """Non-cyclic scroll_chunks for bit matrix blocks arriving one at a time
+
+    blocks are consecutive pieces of a (columns, lines) bit matrix. Only the
+    current block and the columns of the window still being shown are kept,
+    along with up to length pending rows. Unlike scroll_chunks, the last
+    partial chunk is also yielded.
+    """
+    template = window_template(width, posn, step).data
+    shown = len(template) - 2
+    tail = np.zeros((0, 6), dtype=np.uint8)
+    pending = FrameBuffer(length)
+    for block in blocks:
+        bits = np.concatenate((tail, np.asarray(block, dtype=np.uint8)[:, :6]))
+        count = len(bits) - width
+        if count <= 0:
+            tail = bits
+            continue
+        view = sliding_window_view(bits[: count + shown - 1], shown, axis=0)
+        rows = np.tile(template, count).reshape(count, len(template))
+        for i, name in enumerate(OUTPUTS2):
+            rows[name][:, 1:-1] = view[:, i, :]
+        pending.extend(rows.reshape(-1))
+        tail = bits[count:]
+        full = len(pending) // length * length
+        for offset in range(0, full, length):
+            chunk = FrameBuffer(length + 1)
+            chunk.extend(pending.data[offset : offset + length])
+            chunk.append(repeats=0)
+            yield chunk
+        remainder = pending.data[full:].copy()
+        pending = FrameBuffer(length)
+        pending.extend(remainder)
+    if len(pending):
+        pending.append(repeats=0)
+        yield pending
+
+
+def scroll_period(columns, width, length, posn=600, step=6):
+    """Number of chunks after which cyclic scroll_chunks output repeats"""
+    rows = columns * len(window_template(width, posn, step))
+    return rows // gcd(rows, length)
+
+
+def scroll_chunk(bits, width, length, index, posn=600, step=6):
+    """Build only the index'th chunk of cyclic scroll_chunks output"""
+    bits = np.asarray(bits, dtype=np.uint8)[:, :6]
+    template = window_template(width, posn, step).data
+    row = index * length + np.arange(length)
+    window, offset = np.divmod(row, len(template))
+    chunk = FrameBuffer(length + 1)
+    rows = chunk.resize(length)
+    rows[...] = template[offset]
+    shown = (offset > 0) & (offset < len(template) - 1)
+    column = (window[shown] + offset[shown] - 1) % len(bits)
+    for i, name in enumerate(OUTPUTS2):
+        rows[name][shown] = bits[column, i]
+    chunk.append(repeats=0)
+    return chunk
+
+
+class CachedTableStream:
+    """Endless stream of SeqTables for scrolling text, replayed from a cache
+
+    The cyclic scroll output repeats every `period` tables so each table is
+    built once and reused on later loops of the text. Tables are cached until
+    max_bytes is reached, after which further tables are rebuilt each time
+    they are needed. As tables are always requested in the same cyclic order,
+    keeping the earliest tables rather than the most recently used ones means
+    the cache still serves max_bytes worth of every loop.
+
+    start and stride select every stride'th table from start, so that stride
+    streams starting at 0 to stride - 1 share out the tables between them.
+
+    If a table_store.TableStore is given, tables missing from the cache are
+    loaded from it rather than built, and tables that are built are saved to
+    it for the next process showing the same text.
+    """
+
+    def __init__(
+        self,
+        text,
+        width,
+        length,
+        posn=600,
+        step=6,
+        max_bytes=64 << 20,
+        store=None,
+        start=0,
+        stride=1,
+    ):
+        self.text = text
+        self.bits = bit_matrix(text)
+        self.width = width
+        self.length = length
+        self.posn = posn
+        self.step = step
+        self.max_bytes = max_bytes
+        self.store = store
+        self.period = scroll_period(len(self.bits), width, length, posn, step)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stride = stride
+        self._cache = {}
+        self._index = start % self.period
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        index = self._index
+        self._index = (index + self.stride) % self.period
+        if index in self._cache:
+            self.hits += 1
+            return self._cache[index]
+        self.misses += 1
+        with metrics.registry.timer("table_generation_seconds"):
+            chunk = self._chunk(index)
+            table = chunk.to_table()
+        size = chunk.data.nbytes + table["TRIGGER"].nbytes
+        if self.nbytes + size <= self.max_bytes:
+            self._cache[index] = table
+            self.nbytes += size
+        return table
+
+    def _chunk(self, index):
+        def build():
+            return scroll_chunk(
+                self.bits, self.width, self.length, index, self.posn, self.step
+            )
+
+        if self.store is None:
+            return build()
+        key = self.store.key(
+            "scroll_chunk",
+            self.text,
+            FONT,
+            self.width,
+            self.length,
+            index,
+            self.posn,
+            self.step,
+        )
+        return self.store.fetch(key, build)
+
+
 def table_chunks(frames, length):
     """Split stream of frames into groups that can be set as sequence tables"""
     buffer = [iter(frames)] * length
@@ -116,7 +574,14 @@ def table_chunks(frames, length):
 
 def seq_tables(tables):
     for table in tables:
-        yield build_table(*zip(*table))
+        yield as_seq_table(table)
+
+
+def as_seq_table(frames):
+    """Build a SeqTable from either a FrameBuffer or an iterable of Frames"""
+    if isinstance(frames, FrameBuffer):
+        return frames.to_table()
+    return build_table(*zip(*frames))
 
 
 def build_table(
@@ -159,26 +624,340 @@ def build_table(
     return table
 
 
-async def display(pnd, text, limit=50, posn=600, step=6, window=30, chunk=100):
-    src = seq_tables(
-        table_chunks(table_frames(cycle(frames(text)), window, posn, step), chunk)
+SEQ_TICK = 1e-6
+"""Seconds per unit of TIME1 and TIME2 at the sequencer's default prescale"""
+
+
+def table_duration(table, tick=SEQ_TICK):
+    """Seconds a SeqTable takes to run if no row waits for its trigger
+
+    Rows repeating forever (0 repeats) are counted once.
+    """
+    repeats = np.maximum(np.asarray(table["REPEATS"], dtype=np.int64), 1)
+    times = np.asarray(table["TIME1"], np.int64) + np.asarray(table["TIME2"], np.int64)
+    return float(np.dot(repeats, times)) * tick
+
+
+class DisplayStats:
+    """Counters and timings collected while streaming tables to a sequencer
+
+    A starved read is one where the next table had not been built by the time
+    the sequencer asked for it. An underrun is one where the sequencer was no
+    longer active by the time the next table had been written.
+    """
+
+    def __init__(self, history=1000):
+        self.tables = 0
+        self.starved = 0
+        self.starved_time = 0.0
+        self.underruns = 0
+        self.write_times = deque(maxlen=history)
+        """Time from can_write_next rising to the table write completing"""
+        self.underrun_times = deque(maxlen=history)
+        """perf_counter time of each detected underrun"""
+        self.max_lag = 0
+        self.lags = deque(maxlen=history)
+        """Tables behind the leading sequencer after each write"""
+
+    def __repr__(self):
+        return (
+            f"DisplayStats(tables={self.tables}, starved={self.starved}, "
+            f"starved_time={self.starved_time:.3f}, underruns={self.underruns}, "
+            f"max_lag={self.max_lag})"
+        )
+
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+
+class TablePrefetcher:
+    """Build tables ahead of time into a queue of up to depth tables
+
+    If threaded, tables are built in a worker thread so that building them
+    does not hold up the event loop handling the sequencer. Use as an async
+    context manager to start and stop the background producer. An error
+    raised while building a table is raised by the get that would have
+    returned it.
+    """
+
+    def __init__(self, tables, depth=4, threaded=True, stats=None):
+        self._tables = iter(tables)
+        self._queue = asyncio.Queue(maxsize=depth)
+        self._task = None
+        self.threaded = threaded
+        self.stats = stats or DisplayStats()
+
+    async def _produce(self):
+        while True:
+            try:
+                if self.threaded:
+                    table = await asyncio.to_thread(next, self._tables, None)
+                else:
+                    table = next(self._tables, None)
+            except Exception as e:
+                # Hand the error to the consumer rather than leaving it
+                # waiting for a table that will never come
+                await self._queue.put(_ProducerError(e))
+                return
+            await self._queue.put(table)
+            if table is None:
+                return
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._produce())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get(self):
+        """Get the next table, waiting for it to be built if required"""
+        if self._queue.empty():
+            self.stats.starved += 1
+            start = perf_counter()
+            table = await self._queue.get()
+            self.stats.starved_time += perf_counter() - start
+        else:
+            table = self._queue.get_nowait()
+        if table is None:
+            raise StopAsyncIteration
+        if isinstance(table, _ProducerError):
+            raise table.error
+        return table
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+def _is_high(value):
+    return value in (1, True, "1", "ONE")
+
+
+class PhaseClock:
+    """Keeps several table streams within max_skew tables of each other
+
+    A stream that is max_skew tables ahead of the slowest unfinished stream
+    waits in wait_turn before writing its next table.
+    """
+
+    def __init__(self, streams, max_skew=1):
+        self.counts = [0] * streams
+        self.max_skew = max_skew
+        self._finished = set()
+        self._changed = asyncio.Condition()
+
+    def _slowest(self):
+        running = [c for i, c in enumerate(self.counts) if i not in self._finished]
+        return min(running, default=0)
+
+    def lag(self, index):
+        """Number of tables index is behind the leading stream"""
+        return max(self.counts) - self.counts[index]
+
+    async def wait_turn(self, index):
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self.counts[index] - self._slowest() < self.max_skew
+            )
+
+    async def advance(self, index):
+        async with self._changed:
+            self.counts[index] += 1
+            self._changed.notify_all()
+
+    async def finish(self, index):
+        async with self._changed:
+            self._finished.add(index)
+            self._changed.notify_all()
+
+
+async def set_next_table(seq, table, timeout=None):
+    """Write table to a running seq and wait for the sequencer to take it
+
+    can_write_next is watched from before the write, so a 1 left over from
+    before the write is not mistaken for the table having been swapped in: it
+    must fall (or already be 0) and then rise again.
+    """
+    updates = asyncio.Queue()
+
+    def update(value):
+        updates.put_nowait(value)
+
+    seq.can_write_next.subscribe_value(update)
+    try:
+        with metrics.registry.timer("table_set_seconds"):
+            await seq.table.set(table)
+
+        async def taken():
+            low = False
+            while True:
+                ready = await updates.get()
+                if ready != 1:
+                    low = True
+                elif low:
+                    return
+
+        await asyncio.wait_for(taken(), timeout)
+    finally:
+        seq.can_write_next.clear_sub(update)
+
+
+STOP_TIMEOUT = 10.0
+"""Seconds display waits for the stop table to be taken before disabling"""
+
+
+async def _display_seq(seq, src, limit, clock, index, stats):
+    """Stream tables from src to seq each time it can take the next one"""
+    try:
+        await seq.enable.set("ONE")
+        async for ready in observe_value(seq.can_write_next):
+            if ready == 1:
+                start = perf_counter()
+                print("New table time")
+                active, table = await asyncio.gather(seq.bita.get_value(), src.get())
+                if (
+                    limit == 0 or active == "ONE"
+                ):  # intentionally == to allow -1 to be infinite
+                    print("Limit reached: " + active)
+                    stop = build_table([1], ["Immediate"], *([[0]] * 15))
+                    try:
+                        # Let the stop table clear the outputs before disabling
+                        await set_next_table(seq, stop, STOP_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        print("Stop table not taken, disabling anyway")
+                    await seq.enable.set("ZERO")
+                    break
+                await clock.wait_turn(index)
+                with metrics.registry.timer("table_set_seconds"):
+                    await seq.table.set(table)
+                stats.write_times.append(perf_counter() - start)
+                stats.tables += 1
+                metrics.registry.observe("write_gap_seconds", stats.write_times[-1])
+                metrics.registry.inc("tables_written")
+                metrics.registry.inc("rows_written", len(table["REPEATS"]))
+                await clock.advance(index)
+                lag = clock.lag(index)
+                stats.lags.append(lag)
+                stats.max_lag = max(stats.max_lag, lag)
+                if not _is_high(await seq.active.get_value()):
+                    stats.underruns += 1
+                    stats.underrun_times.append(perf_counter())
+                    metrics.registry.inc("underruns")
+                    print(f"Underrun: sequencer idle before table {stats.tables}")
+
+                limit -= 1
+    finally:
+        await clock.finish(index)
+
+
+async def display_multi(
+    seqs,
+    text,
+    limit=50,
+    posn=600,
+    step=6,
+    window=30,
+    chunk=100,
+    max_cache=64 << 20,
+    prefetch=4,
+    max_skew=1,
+    store=None,
+):
+    """Display scrolling text on several sequencers at once
+
+    seqs are sequencer blocks (eg pnd.seq1, pnd.seq2, other_pnd.seq1), each
+    with its own can_write_next handshake. If text is a string its tables are
+    dealt out in turn, so with n sequencers each takes every n'th table of
+    the scroll and only needs to keep up with 1/n of the table rate. Given a
+    list with one text per sequencer, each sequencer scrolls its own text.
+    limit is the number of tables written to each sequencer. The streams are
+    kept within max_skew tables of each other. Sequencers of a LazyPandA are
+    connected first. Tables are loaded from and saved to store if given.
+    Returns the DisplayStats of each sequencer.
+    """
+    shared = isinstance(text, str)
+    texts = [text] * len(seqs) if shared else list(text)
+    if len(texts) != len(seqs):
+        raise ValueError(f"{len(texts)} texts given for {len(seqs)} sequencers")
+    await connect_blocks_of(*seqs)
+    clock = PhaseClock(len(seqs), max_skew)
+    stats = [DisplayStats() for _ in seqs]
+    streams = [
+        CachedTableStream(
+            txt,
+            window,
+            chunk,
+            posn,
+            step,
+            max_cache // len(seqs),
+            store,
+            start=index if shared else 0,
+            stride=len(seqs) if shared else 1,
+        )
+        for index, txt in enumerate(texts)
+    ]
+    await asyncio.gather(
+        *(seq.table.set(next(tables)) for seq, tables in zip(seqs, streams))
+    )
+    async with AsyncExitStack() as stack:
+        sources = [
+            await stack.enter_async_context(TablePrefetcher(tables, prefetch, stats=st))
+            for tables, st in zip(streams, stats)
+        ]
+        await asyncio.gather(
+            *(
+                _display_seq(seq, src, limit, clock, index, st)
+                for index, (seq, src, st) in enumerate(zip(seqs, sources, stats))
+            )
+        )
+    for st in stats:
+        print(st)
+    return stats
+
+
+async def display(
+    pnd,
+    text,
+    limit=50,
+    posn=600,
+    step=6,
+    window=30,
+    chunk=100,
+    max_cache=64 << 20,
+    prefetch=4,
+    store=None,
+):
+    (stats,) = await display_multi(
+        [pnd.seq1],
+        text,
+        limit,
+        posn,
+        step,
+        window,
+        chunk,
+        max_cache,
+        prefetch,
+        store=store,
     )
-    await pnd.seq1.table.set(next(src))
-    await pnd.seq1.enable.set("ONE")
-    async for ready in observe_value(pnd.seq1.can_write_next):
-        if ready == 1:
-            print("New table time")
-            active = await pnd.seq1.bita.get_value()
-            if (
-                limit == 0 or active == "ONE"
-            ):  # intentionally == to allow -1 to be infinite
-                print("Limit reached: " + active)
-                await pnd.seq1.table.set(build_table([1], ["Immediate"], *([[0]] * 15)))
-                await pnd.seq1.enable.set("ZERO")
-                break
-            await pnd.seq1.table.set(next(src))
-
-            limit -= 1
+    return stats
 
 
 def test_frames():
@@ -229,3 +1008,177 @@ def test_table_chunks():
     tc = table_chunks(range(100), 12)
     first = next(tc)
     assert len(first) == 13
+
+
+def test_frame_buffer():
+    rows = list(table_chunks(table_frames(frames("abcd"), 12), 20))[0]
+    buf = FrameBuffer.from_frames(rows)
+    assert len(buf) == len(rows)
+    assert list(buf) == rows
+    assert buf[3:5] == FrameBuffer.from_frames(rows[3:5])
+    expected = build_table(*zip(*rows))
+    actual = as_seq_table(buf)
+    for key, column in expected.items():
+        assert (actual[key] == column).all()
+    assert np.shares_memory(actual["OUTA2"], buf.data)
+
+
+def test_frame_buffer_extend_columns():
+    buf = FrameBuffer(capacity=2)
+    buf.append(trigger="POSA>=POSITION", position=600)
+    buf.extend(
+        trigger="POSA<=POSITION", position=np.arange(600, 0, -6), outa2=[1] * 100
+    )
+    assert len(buf) == 101
+    assert buf[0] == frame(trigger="POSA>=POSITION", position=600)
+    assert buf[100] == frame(trigger="POSA<=POSITION", position=6, outa2=1)
+    assert (buf.column("repeats") == 1).all()
+
+
+def test_scroll_chunks():
+    for text, width, step, length in (("abcd", 12, 6, 20), ("hello world", 30, 40, 7)):
+        expected = table_chunks(table_frames(frames(text), width, 600, step), length)
+        actual = scroll_chunks(bit_matrix(text), width, length, 600, step, False)
+        assert list(actual) == [FrameBuffer.from_frames(c) for c in expected]
+
+
+def test_scroll_chunks_cyclic():
+    expected = table_chunks(table_frames(cycle(frames("abc")), 30), 100)
+    actual = scroll_chunks(bit_matrix("abc"), 30, 100)
+    for _ in range(50):
+        assert next(actual) == FrameBuffer.from_frames(next(expected))
+
+
+def test_stream_chunks():
+    for text, width, step, length in (("abcd", 12, 6, 20), ("hello world", 30, 40, 7)):
+        bits = bit_matrix(text)
+        expected = list(scroll_chunks(bits, width, length, 600, step, False))
+        blocks = np.array_split(bits, 5)
+        actual = list(stream_chunks(blocks, width, length, 600, step))
+        assert actual[: len(expected)] == expected
+        rows = (len(bits) - width) * len(window_template(width, 600, step))
+        assert sum(len(c) - 1 for c in actual) == rows
+
+
+def test_scroll_chunk():
+    bits = bit_matrix("abc")
+    chunks = scroll_chunks(bits, 30, 100)
+    assert scroll_period(len(bits), 30, 100) == 168
+    for index in range(40):
+        assert next(chunks) == scroll_chunk(bits, 30, 100, index)
+
+
+def test_cached_table_stream():
+    stream = CachedTableStream("abc", 30, 100, max_bytes=50_000)
+    expected = seq_tables(scroll_chunks(bit_matrix("abc"), 30, 100))
+    for _ in range(2 * stream.period):
+        table = next(stream)
+        for key, column in next(expected).items():
+            assert (table[key] == column).all()
+    assert 0 < stream.nbytes <= 50_000
+    assert stream.hits + stream.misses == 2 * stream.period
+    assert 0 < stream.hits < stream.period
+
+
+def test_cached_table_stream_partition():
+    full = CachedTableStream("abc", 30, 100)
+    tables = [next(full) for _ in range(full.period)]
+    part = CachedTableStream("abc", 30, 100, start=1, stride=3)
+    for index in (1, 4, 7):
+        table = next(part)
+        for key, column in tables[index % full.period].items():
+            assert (table[key] == column).all()
+
+
+def test_table_prefetcher():
+    def slow_tables():
+        for i in range(5):
+            if i == 3:
+                sleep(0.05)
+            yield i
+
+    async def consume():
+        async with TablePrefetcher(slow_tables(), depth=2) as src:
+            await asyncio.sleep(0.01)
+            return [t async for t in src], src.stats
+
+    tables, stats = asyncio.run(consume())
+    assert tables == [0, 1, 2, 3, 4]
+    assert stats.starved >= 1
+    assert stats.starved_time > 0.02
+
+
+def test_table_prefetcher_error():
+    def failing_tables():
+        yield 0
+        raise ValueError("bad table")
+
+    async def consume():
+        got = []
+        async with TablePrefetcher(failing_tables(), depth=2) as src:
+            try:
+                async for table in src:
+                    got.append(table)
+            except ValueError as e:
+                return got, str(e)
+
+    assert asyncio.run(asyncio.wait_for(consume(), 1)) == ([0], "bad table")
+
+
+def test_fold_repeats():
+    rows = [
+        frame(trigger="POSA>=POSITION", position=600),
+        frame(trigger="POSA>=POSITION", position=600),
+        frame(time1=10, outa1=1),
+        frame(time1=10, outa1=1, repeats=3),
+        frame(time1=10, outa1=1),
+        frame(time1=10, outa1=0),
+        frame(time2=5, repeats=60_000),
+        frame(time2=5, repeats=10_000),
+        frame(repeats=0),
+        frame(repeats=0),
+    ]
+    folded, ratio = fold_repeats(rows)
+    assert list(folded) == [
+        frame(trigger="POSA>=POSITION", position=600),
+        frame(trigger="POSA>=POSITION", position=600),
+        frame(time1=10, outa1=1, repeats=5),
+        frame(time1=10, outa1=0),
+        frame(time2=5, repeats=MAX_REPEATS),
+        frame(time2=5, repeats=70_000 - MAX_REPEATS),
+        frame(repeats=0),
+        frame(repeats=0),
+    ]
+    assert ratio == 10 / 8
+
+
+
+def test_table_duration():
+    rows = [
+        frame(time1=10, time2=5, repeats=3),
+        frame(time2=20),
+        frame(repeats=0, time1=5),
+    ]
+    assert table_duration(as_seq_table(rows)) == 70e-6
+    assert table_duration(as_seq_table(rows), tick=1e-3) == 70e-3
+
+def test_phase_clock():
+    async def run():
+        clock = PhaseClock(2, max_skew=1)
+        skew = []
+
+        async def stream(index, count, delay):
+            for _ in range(count):
+                await clock.wait_turn(index)
+                await asyncio.sleep(delay)
+                await clock.advance(index)
+                skew.append(clock.counts[0] - clock.counts[1])
+            await clock.finish(index)
+
+        await asyncio.gather(stream(0, 3, 0), stream(1, 5, 0.01))
+        return clock, skew
+
+    clock, skew = asyncio.run(run())
+    assert clock.counts == [3, 5]
+    assert max(skew) == 1
+    assert clock.lag(0) == 2
@@ -1,8 +1,104 @@
+import asyncio
 from time import time
 from enum import Enum
-from ophyd.v2.core import Device, StandardReadable, wait_for_value
+from typing import Dict, Iterator
+
+import numpy as np
+import numpy.typing as npt
+from bluesky.protocols import Descriptor, Flyable, PartialEventPage
+from ophyd.v2.core import (
+    AsyncStatus,
+    Device,
+    StandardReadable,
+    set_sim_value,
+    wait_for_value,
+)
 from ophyd.v2.epics import epics_signal_r, epics_signal_rw
 
+READINGS = (
+    "current_1",
+    "current_2",
+    "current_3",
+    "current_4",
+    "position_x",
+    "position_y",
+)
+
+
+class DataLossError(RuntimeError):
+    """Readings were lost during a fly scan"""
+
+
+class ReadingRing:
+    """Ring buffer of readings, one float64 column per name
+
+    Readings are appended in blocks and taken out in bulk with pop. If more
+    than capacity readings are pushed without being popped, the oldest are
+    overwritten and counted in dropped. The buffer is allocated by the first
+    push, so an unused ring costs nothing.
+    """
+
+    def __init__(self, names=READINGS, capacity=100_000):
+        self.dtype = np.dtype([("time", np.float64)] + [(n, np.float64) for n in names])
+        self._capacity = capacity
+        self._data = None
+        self._start = 0
+        self._len = 0
+        self.total = 0
+        self.dropped = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._len
+
+    def push(self, timestamp, columns, interval=0.0):
+        """Append a block of readings given as equal length arrays per name
+
+        timestamp is the time of the last reading in the block, the others
+        are spaced interval seconds before it.
+        """
+        if self._data is None:
+            self._data = np.zeros(self.capacity, self.dtype)
+        length = len(next(iter(columns.values())))
+        times = timestamp - interval * np.arange(length - 1, -1, -1.0)
+        self.total += length
+        if length > self.capacity:
+            self.dropped += length - self.capacity
+            columns = {name: value[-self.capacity :] for name, value in columns.items()}
+            times = times[-self.capacity :]
+            length = self.capacity
+        overflow = max(0, self._len + length - self.capacity)
+        if overflow:
+            self.dropped += overflow
+            self._start = (self._start + overflow) % self.capacity
+            self._len -= overflow
+        index = (self._start + self._len + np.arange(length)) % self.capacity
+        self._data["time"][index] = times
+        for name, value in columns.items():
+            self._data[name][index] = value
+        self._len += length
+
+    def pop(self, limit=None):
+        """Remove and return up to limit of the oldest readings as one array"""
+        length = self._len if limit is None else min(limit, self._len)
+        if not length:
+            return np.zeros(0, self.dtype)
+        index = (self._start + np.arange(length)) % self.capacity
+        block = self._data[index]
+        self._start = (self._start + length) % self.capacity
+        self._len -= length
+        return block
+
+    def clear(self, capacity=None):
+        """Empty the ring, resizing it to capacity if given"""
+        if capacity is not None and capacity != self._capacity:
+            self._capacity = capacity
+            self._data = None
+        self._start = self._len = self.total = self.dropped = 0
+
 
 class TetrammRange(Enum):
     uA = "+- 120 uA"
@@ -39,7 +135,7 @@ class TetrammGeometry(Enum):
     Square = "Square"
 
 
-class Tetramm(StandardReadable):
+class Tetramm(StandardReadable, Flyable):
     base_sample_rate: int
     """base rate"""
 
@@ -81,6 +177,9 @@ class Tetramm(StandardReadable):
         idle_trigger_state=TetrammTrigger.FreeRun,
         idle_averaging_time=0.1,
         idle_values_per_reading=10,
+        ring_capacity=1_000_000,
+        page_size=10_000,
+        fly_timeout=60.0,
     ):
         self._base_pv = base_pv
         self.range = epics_signal_rw(TetrammRange, base_pv + ":DRV:Range")
@@ -119,6 +218,23 @@ class Tetramm(StandardReadable):
         self.position_x = epics_signal_r(float, base_pv + ":PosX:MeanValue_RBV")
         self.position_y = epics_signal_r(float, base_pv + ":PosY:MeanValue_RBV")
 
+        self.series_acquire = epics_signal_rw(bool, base_pv + ":TS:TSAcquire")
+        self.series_points = epics_signal_rw(int, base_pv + ":TS:TSNumPoints")
+        self._series = {
+            name: epics_signal_r(
+                npt.NDArray[np.float64], base_pv + f":TS:{pv}:TimeSeries"
+            )
+            for name, pv in zip(
+                READINGS, ("Cur1", "Cur2", "Cur3", "Cur4", "PosX", "PosY")
+            )
+        }
+        self.series_current_1 = self._series["current_1"]
+        self.series_current_2 = self._series["current_2"]
+        self.series_current_3 = self._series["current_3"]
+        self.series_current_4 = self._series["current_4"]
+        self.series_position_x = self._series["position_x"]
+        self.series_position_y = self._series["position_y"]
+
         self.base_sample_rate = base_sample_rate
         self.maximum_readings_per_frame = maximum_readings_per_frame
         self.minimum_values_per_reading = minimum_values_per_reading
@@ -128,99 +244,404 @@ class Tetramm(StandardReadable):
         self.idle_averaging_time = idle_averaging_time
         self.idle_values_per_reading = idle_values_per_reading
 
+        self._readings = {name: getattr(self, name) for name in READINGS}
+        self._description = None
+        self._monitors = {}
+        self._cache = {}
+        self._cache_time = None
+        self._confirmed = {}
+
+        self.page_size = page_size
+        self.fly_readings = None
+        """Number of readings complete waits for, None to stop immediately"""
+        self.fly_timeout = fly_timeout
+        """Seconds complete waits for fly_readings before giving up"""
+        self.ring_capacity = ring_capacity
+        self.ring = ReadingRing(READINGS, ring_capacity)
+        self._pending = {}
+        self._stale = {}
+        self._interval = 0.0
+        self._series_monitors = {}
+        self._start_overflows = 0
+        self._collected = 0
+
         self.set_readable_signals(
-            read=[
-                self.current_1,
-                self.current_2,
-                self.current_3,
-                self.current_4,
-                self.position_x,
-                self.position_y,
-            ],
+            read=list(self._readings.values()),
             config=[self.values_per_reading, self.averaging_time, self.sample_time],
         )
         super().__init__(name=name)
 
-    def describe(self):
+    async def connect(self, *args, **kwargs):
+        await super().connect(*args, **kwargs)
+        self._description = self._describe()
+
+    def _describe(self):
         return {
-            "current_1": {
-                "source": self.current_1.source,
-                "dtype": "number",
-                "shape": [],
-            },
-            "current_2": {
-                "source": self.current_1.source,
-                "dtype": "number",
-                "shape": [],
-            },
-            "current_3": {
-                "source": self.current_1.source,
-                "dtype": "number",
-                "shape": [],
-            },
-            "current_4": {
-                "source": self.current_1.source,
-                "dtype": "number",
-                "shape": [],
-            },
-            "position_x": {
-                "source": self.current_1.source,
-                "dtype": "number",
-                "shape": [],
-            },
-            "position_y": {
-                "source": self.current_1.source,
-                "dtype": "number",
-                "shape": [],
-            },
+            name: {"source": signal.source, "dtype": "number", "shape": []}
+            for name, signal in self._readings.items()
         }
 
-    def read(self):
+    def describe(self):
+        if self._description is None:
+            self._description = self._describe()
+        return self._description
+
+    def start_monitoring(self):
+        """Keep the latest value of each reading from monitors
+
+        While monitoring (and once every reading has had an update) read is
+        served from these values without going to the IOC.
+        """
+        if self._monitors:
+            return
+        for name, signal in self._readings.items():
+
+            def update(value, name=name):
+                self._cache[name] = value
+                self._cache_time = time()
+
+            signal.subscribe_value(update)
+            self._monitors[name] = update
+
+    def stop_monitoring(self):
+        for name, update in self._monitors.items():
+            self._readings[name].clear_sub(update)
+        self._monitors.clear()
+        self._cache.clear()
+        self._cache_time = None
+
+    async def read(self):
+        """Snapshot of all readings sharing a single timestamp"""
+        if self._monitors and len(self._cache) == len(self._readings):
+            values = dict(self._cache)
+            timestamp = self._cache_time
+        else:
+            values = dict(
+                zip(
+                    self._readings,
+                    await asyncio.gather(
+                        *(signal.get_value() for signal in self._readings.values())
+                    ),
+                )
+            )
+            timestamp = time()
         return {
-                'current_1': {'value': self.current_1.get_value(), 'timestamp': time()},
-                'current_2': {'value': self.current_2.get_value(), 'timestamp': time()},
-                'current_3': {'value': self.current_3.get_value(), 'timestamp': time()},
-                'current_4': {'value': self.current_4.get_value(), 'timestamp': time()},
-                'position_x': {'value': self.position_x.get_value(), 'timestamp': time()},
-                'position_y': {'value': self.position_y.get_value(), 'timestamp': time()},
-                }
+            name: {"value": value, "timestamp": timestamp}
+            for name, value in values.items()
+        }
+
+    async def _confirmed_value(self, signal):
+        if signal not in self._confirmed:
+            self._confirmed[signal] = await signal.get_value()
+        return self._confirmed[signal]
+
+    async def _set_if_changed(self, signal, value):
+        if await self._confirmed_value(signal) == value:
+            return False
+        await signal.set(value)
+        # The IOC may round or clamp the value, so cache what it now holds
+        self._confirmed[signal] = await signal.get_value()
+        return True
+
+    async def configure(self, *settings):
+        """Apply (signal, value) settings concurrently, skipping any in effect
+
+        Values are compared against the value read back from each signal when
+        it was last written or read. Returns the signals that were written.
+        """
+        changed = await asyncio.gather(
+            *(self._set_if_changed(signal, value) for signal, value in settings)
+        )
+        return [signal for (signal, _), write in zip(settings, changed) if write]
+
+    def invalidate_configuration(self):
+        """Forget cached config values, eg if they were changed elsewhere"""
+        self._confirmed.clear()
 
     async def set_frame_time(self, seconds):
-        await self.averaging_time.set(seconds / 1_000)
         values_per_reading = (
             seconds * self.base_sample_rate / self.maximum_readings_per_frame
         )
         if values_per_reading < self.minimum_values_per_reading:
             values_per_reading = self.minimum_values_per_reading
-        await self.values_per_reading.set(values_per_reading)
-        await self._refresh_file_size_dimensions(seconds)
+        changed = await self.configure(
+            (self.averaging_time, seconds / 1_000),
+            (self.values_per_reading, int(values_per_reading)),
+        )
+        if changed:
+            await self._refresh_file_size_dimensions(seconds)
 
     async def _refresh_file_size_dimensions(self, seconds):
         if not self.idle_acquire or self.idle_trigger_state != TetrammTrigger.FreeRun:
-            self.acquire.set(False)
-            self.trigger.set(TetrammTrigger.FreeRun)
-            self.acquire.set(True)
+            await self.acquire.set(False)
+            await self.trigger.set(TetrammTrigger.FreeRun)
+            await self.acquire.set(True)
             target = await self.to_average.get_value()
             await wait_for_value(self.averaged, target, seconds * 2)
-            self.acquire.set(False)
-
-    def stage(self):
-        # set averaging time
-        # set dimensions
-        # stop idle acquire
-        # set trigger to ext trig
-        # set collection time?
-        # set geometry
-        # set range
-        # set resolution
-        # set acquire?
-        # set recording?
-        pass
-
-    def unstage(self):
-        # stop acquiring
-        # set idle trigger state
-        # set idle averaging time
-        # set idle values per reading
-        # set acquire if needed
-        pass
+            await self.acquire.set(False)
+            self._confirmed[self.acquire] = False
+            self._confirmed[self.trigger] = TetrammTrigger.FreeRun
+
+    @AsyncStatus.wrap
+    async def stage(self):
+        await self.configure((self.acquire, False))
+        await self.configure(
+            (self.trigger, TetrammTrigger.ExtTrigger),
+            (self.geometry, self.collection_geometry),
+            (self.range, self.collection_range),
+            (self.resolution, self.collection_resolution),
+        )
+        await self.configure((self.acquire, True))
+
+    @AsyncStatus.wrap
+    async def unstage(self):
+        await self.configure((self.acquire, False))
+        await self.configure(
+            (self.trigger, self.idle_trigger_state),
+            (self.averaging_time, self.idle_averaging_time),
+            (self.values_per_reading, self.idle_values_per_reading),
+        )
+        if self.idle_acquire:
+            await self.configure((self.acquire, True))
+
+    def _on_series(self, name, reading):
+        (reading,) = reading.values()
+        # Anything not newer than the waveform at kickoff is left over from a
+        # previous series, however late its monitor update arrives
+        if reading["timestamp"] <= self._stale.get(name, -np.inf):
+            return
+        # Each channel's waveform arrives separately, only push once all the
+        # channels have delivered their part of the same block
+        self._pending[name] = reading
+        if len(self._pending) == len(self._series):
+            values = {
+                n: np.asarray(r["value"], dtype=np.float64)
+                for n, r in self._pending.items()
+            }
+            length = min(len(value) for value in values.values())
+            if length:
+                columns = {n: v[:length] for n, v in values.items()}
+                timestamp = max(r["timestamp"] for r in self._pending.values())
+                self.ring.push(timestamp, columns, self._interval)
+            self._pending.clear()
+
+    def _start_series(self):
+        for name, signal in self._series.items():
+
+            def update(reading, name=name):
+                self._on_series(name, reading)
+
+            signal.subscribe(update)
+            self._series_monitors[name] = update
+
+    def _stop_series(self):
+        for name, update in self._series_monitors.items():
+            self._series[name].clear_sub(update)
+        self._series_monitors.clear()
+        self._pending.clear()
+
+    async def _check_overflows(self):
+        overflows = await self.overflows.get_value() - self._start_overflows
+        if overflows or self.ring.dropped:
+            raise DataLossError(
+                f"{self.name}: {overflows} IOC ring overflows, "
+                f"{self.ring.dropped} readings dropped from the ring buffer"
+            )
+
+    async def _timestamp(self, signal):
+        (reading,) = (await signal.read()).values()
+        return reading["timestamp"]
+
+    @AsyncStatus.wrap
+    async def kickoff(self):
+        self._start_overflows = await self.overflows.get_value()
+        await self.configure((self.series_points, self.page_size))
+        # Readings in a block are sample_time apart
+        self._interval = await self.sample_time.get_value()
+        names = list(self._series)
+        stale = await asyncio.gather(
+            *(self._timestamp(self._series[name]) for name in names)
+        )
+        self._stale = dict(zip(names, stale))
+        # Readings arrive in driver sized blocks, so the last can overshoot
+        # fly_readings, leave room for it rather than losing the first ones
+        self.ring.clear(
+            max(self.ring_capacity, (self.fly_readings or 0) + self.page_size)
+        )
+        self._collected = 0
+        self._pending.clear()
+        self._start_series()
+        await self.series_acquire.set(True)
+
+    async def _wait_for_readings(self):
+        while self.ring.total < self.fly_readings:
+            await self._check_overflows()
+            await asyncio.sleep(0.1)
+
+    @AsyncStatus.wrap
+    async def complete(self):
+        try:
+            if self.fly_readings is not None:
+                await asyncio.wait_for(self._wait_for_readings(), self.fly_timeout)
+            await self.series_acquire.set(False)
+            await self._check_overflows()
+        finally:
+            self._stop_series()
+
+    def collect_pages(self) -> Iterator[PartialEventPage]:
+        """Emit the readings collected so far in pages of up to page_size
+
+        Readings past fly_readings, from the end of the last block, are
+        discarded.
+        """
+        while len(self.ring):
+            limit = self.page_size
+            if self.fly_readings is not None:
+                limit = min(limit, self.fly_readings - self._collected)
+                if limit <= 0:
+                    self.ring.pop()
+                    break
+            block = self.ring.pop(limit)
+            self._collected += len(block)
+            yield {
+                "time": block["time"],
+                "data": {f"{self.name}-{n}": block[n] for n in READINGS},
+                "timestamps": {f"{self.name}-{n}": block["time"] for n in READINGS},
+            }
+
+    def describe_collect(self) -> Dict[str, Dict[str, Descriptor]]:
+        return {
+            self.name: {
+                f"{self.name}-{name}": {
+                    "source": signal.source,
+                    "dtype": "number",
+                    "shape": [],
+                }
+                for name, signal in self._series.items()
+            }
+        }
+
+
+def test_tetramm_read():
+    async def run():
+        tetramm = Tetramm("tetramm", "SIM-TETRAMM")
+        await tetramm.connect(sim=True)
+        for i, signal in enumerate(tetramm._readings.values()):
+            set_sim_value(signal, float(i))
+        description = tetramm.describe()
+        assert description["position_y"]["source"] == tetramm.position_y.source
+        assert tetramm.describe() is description
+        reading = await tetramm.read()
+        assert [r["value"] for r in reading.values()] == [0, 1, 2, 3, 4, 5]
+        assert len({r["timestamp"] for r in reading.values()}) == 1
+        tetramm.start_monitoring()
+        set_sim_value(tetramm.current_1, 10.0)
+        assert tetramm._cache["current_1"] == 10.0
+        assert (await tetramm.read())["current_1"]["value"] == 10.0
+        tetramm.stop_monitoring()
+
+    asyncio.run(run())
+
+
+def test_tetramm_configure_skips_unchanged():
+    async def run():
+        tetramm = Tetramm("tetramm", "SIM-TETRAMM", idle_acquire=True)
+        await tetramm.connect(sim=True)
+        writes = []
+        for signal in (tetramm.averaging_time, tetramm.values_per_reading):
+            signal.subscribe_value(lambda v, s=signal: writes.append(s))
+        writes.clear()
+        await tetramm.set_frame_time(100)
+        assert len(writes) == 2
+        await tetramm.set_frame_time(100)
+        assert len(writes) == 2
+        await tetramm.stage()
+        assert await tetramm.trigger.get_value() == TetrammTrigger.ExtTrigger
+        settings = (tetramm.trigger, TetrammTrigger.ExtTrigger)
+        assert await tetramm.configure(settings) == []
+        await tetramm.unstage()
+        assert await tetramm.trigger.get_value() == TetrammTrigger.FreeRun
+        assert await tetramm.acquire.get_value()
+
+        # What the IOC reads back is cached, not the value asked for
+        async def clamp(value, wait=True):
+            set_sim_value(tetramm.values_per_reading, min(value, 1000))
+
+        tetramm.values_per_reading.set = clamp
+        vpr = tetramm.values_per_reading
+        assert await tetramm.configure((vpr, 5000)) == [vpr]
+        assert tetramm._confirmed[vpr] == 1000
+        assert await tetramm.configure((vpr, 1000)) == []
+
+    asyncio.run(run())
+
+
+def test_reading_ring():
+    ring = ReadingRing(("a",), capacity=5)
+    ring.push(1.0, {"a": np.arange(3.0)})
+    ring.push(2.0, {"a": np.arange(3.0, 6.0)})
+    assert ring.dropped == 1
+    block = ring.pop(2)
+    assert block["a"].tolist() == [1, 2]
+    # Both are what is left of the first block
+    assert block["time"].tolist() == [1, 1]
+    ring.push(3.0, {"a": np.arange(6.0, 10.0)})
+    assert ring.pop()["a"].tolist() == [5, 6, 7, 8, 9]
+    assert ring.total == 10 and ring.dropped == 3 and len(ring) == 0
+    ring.clear(capacity=8)
+    assert ring._data is None
+    ring.push(2.0, {"a": np.zeros(3)}, interval=0.5)
+    assert ring.pop()["time"].tolist() == [1.0, 1.5, 2.0]
+
+
+def test_tetramm_fly():
+    async def run():
+        tetramm = Tetramm("tetramm", "SIM-TETRAMM", page_size=4)
+        await tetramm.connect(sim=True)
+        tetramm.fly_readings = 8
+        await tetramm.kickoff()
+        for block in range(2):
+            for i, signal in enumerate(tetramm._series.values()):
+                set_sim_value(signal, np.full(4, 10.0 * block + i))
+        await tetramm.complete()
+        pages = list(tetramm.collect_pages())
+        assert len(pages) == 2
+        assert pages[1]["data"]["tetramm-current_2"].tolist() == [11.0] * 4
+
+        # Blocks overshooting fly_readings lose nothing, the surplus is cut
+        tetramm.ring_capacity = 8
+        await tetramm.kickoff()
+        for block in range(2):
+            for i, signal in enumerate(tetramm._series.values()):
+                set_sim_value(signal, np.full(5, 10.0 * block + i))
+        await tetramm.complete()
+        pages = list(tetramm.collect_pages())
+        assert [len(page["time"]) for page in pages] == [4, 4]
+        assert pages[1]["data"]["tetramm-current_1"].tolist() == [0.0, 10.0, 10.0, 10.0]
+        assert len(tetramm.ring) == 0
+        set_sim_value(tetramm.overflows, 3)
+        await tetramm.kickoff()
+        set_sim_value(tetramm.overflows, 4)
+        tetramm.fly_readings = None
+        try:
+            await tetramm.complete()
+        except DataLossError:
+            pass
+        else:
+            raise AssertionError("overflow not detected")
+
+        # A previous series' waveform arriving late is not recorded
+        tetramm.fly_readings, tetramm.fly_timeout = 4, 0.2
+        await tetramm.kickoff()
+        stale = {"x": {"value": np.zeros(4), "timestamp": 0.0}}
+        tetramm._on_series("current_1", stale)
+        assert "current_1" not in tetramm._pending
+        # and complete gives up if the readings never arrive
+        try:
+            await tetramm.complete()
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("complete did not time out")
+
+    asyncio.run(run())